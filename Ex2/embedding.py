@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import PCA, IncrementalPCA, TruncatedSVD
+from sklearn.manifold import TSNE
+from sklearn.neighbors import KDTree
+
+from features import temp_path
+
+# Dimensionality reductions of the color histograms for main.py.
+
+
+# Converts the (N, N_BINS_COLOR^3) color histograms into the float32 feature matrix of the reductions. With
+# sparse_features the matrix is built as CSR block by block (chunk_rows images at a time), so the mostly empty
+# histograms are never held as one dense float matrix.
+def feature_matrix(color_hists, sparse_features=False, chunk_rows=4096):
+    if not sparse_features:
+        return np.asarray(color_hists, dtype=np.float32)
+    blocks = [sparse.csr_matrix(np.asarray(color_hists[start:start + chunk_rows], dtype=np.float32))
+              for start in range(0, len(color_hists), chunk_rows)]
+    return sparse.vstack(blocks, format="csr")
+
+
+# The linear projection. PCA has to center the data, which would make a sparse matrix dense, so sparse features use
+# TruncatedSVD instead.
+def linear_reducer(n_components, sparse_features=False):
+    if sparse_features:
+        return TruncatedSVD(n_components=n_components)
+    return PCA(n_components=n_components)
+
+
+# Returns project(rows), a running 2D IncrementalPCA that places images while they are still being ingested: every batch
+# of color histograms is folded into the fit and projected with it. Earlier batches keep their older coordinates, so
+# this is only a preview until the real embedding is computed.
+def preview_projector():
+    reducer = IncrementalPCA(n_components=2)
+
+    def project(rows):
+        rows = np.asarray(rows, dtype=np.float32)
+        if len(rows) >= 2:
+            reducer.partial_fit(rows)
+        if not hasattr(reducer, "components_"):
+            return np.zeros((len(rows), 2), dtype=np.float32)
+        return reducer.transform(rows).astype(np.float32)
+    return project
+
+
+def n_components_for(features, n_intermediate):
+    n_samples, n_features = features.shape
+    if n_intermediate is None:
+        return 2
+    return max(2, min(n_intermediate, n_samples - 1, n_features - 1))
+
+
+# Fits the linear projection. In incremental mode an IncrementalPCA is used: a reducer that was fitted on an earlier
+# start is only updated with partial_fit on new_rows (the rows of the images it has not seen yet) instead of being
+# refitted on everything. IncrementalPCA needs at least n_components rows per update, fewer new rows are only projected
+# and folded in on a later start. Returns the reducer and whether new_rows were folded in.
+def fit_reducer(features, n_components, sparse_features=False, incremental=False, reducer=None, new_rows=None,
+                chunk_rows=4096):
+    if not incremental:
+        return linear_reducer(n_components, sparse_features).fit(features), True
+    if reducer is None or new_rows is None or reducer.n_components != n_components:
+        return IncrementalPCA(n_components=n_components, batch_size=max(chunk_rows, n_components)).fit(features), True
+    if len(new_rows) < n_components:
+        return reducer, False
+    for batch in np.array_split(new_rows, max(1, len(new_rows) // max(chunk_rows, n_components))):
+        rows = features[batch]
+        reducer.partial_fit(rows.toarray() if sparse.issparse(rows) else rows)
+    return reducer, True
+
+
+# Computes the 2D linear (PCA / TruncatedSVD) and t-SNE embeddings of the feature matrix with a fitted reducer (see
+# fit_reducer) and returns them with the full projection. Its first two components are the 2D projection and t-SNE
+# runs on all of them instead of on the raw N_BINS_COLOR^3 dimensions (n_intermediate=None keeps the raw histograms for
+# t-SNE).
+def embed(features, reducer, n_intermediate=50):
+    reduced = reducer.transform(features).astype(np.float32)
+    linear = reduced[:, :2]
+
+    tsne_input = reduced if n_intermediate is not None else features
+    # (the perplexity has to be smaller than the number of images, the fixed seed keeps it reproducible)
+    tsne = TSNE(n_components=2, perplexity=min(30, len(reduced) - 1), random_state=0) \
+        .fit_transform(tsne_input).astype(np.float32)
+    return linear, tsne, reduced
+
+
+# Hash of the color histograms (read chunk_rows rows at a time, so memory mapped matrices are streamed) and of the
+# reducer parameters. The cached embeddings are only used if it did not change.
+def feature_hash(color_hists, params, chunk_rows=4096):
+    h = hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=16)
+    h.update(repr(color_hists.shape).encode())
+    for start in range(0, len(color_hists), chunk_rows):
+        h.update(np.ascontiguousarray(color_hists[start:start + chunk_rows]).tobytes())
+    return h.hexdigest()
+
+
+# Returns the 2D linear and t-SNE embeddings of the color histograms and the full linear projection (see embed). They
+# are stored in cache_dir/embedding.npz together with the hash of the features and parameters, so an unchanged image set
+# loads them instead of recomputing them. In incremental mode the IncrementalPCA is kept in cache_dir/reducer.pkl with
+# the paths it was fitted on, so images that were added since then are folded into the projection (see fit_reducer).
+# t-SNE has no out of sample transform and is always recomputed when the features changed.
+def load_embedding(color_hists, paths, cache_dir=None, sparse_features=False, n_intermediate=50, incremental=False):
+    params = dict(sparse=sparse_features, n_intermediate=n_intermediate, incremental=incremental)
+    key = feature_hash(color_hists, params)
+    embedding_file = cache_dir and os.path.join(cache_dir, "embedding.npz")
+    reducer_file = cache_dir and os.path.join(cache_dir, "reducer.pkl")
+
+    if embedding_file and os.path.exists(embedding_file):
+        with np.load(embedding_file) as cached:
+            if str(cached["key"]) == key:
+                return cached["linear"], cached["tsne"], cached["reduced"]
+
+    reducer, fitted_paths = None, set()
+    if incremental and reducer_file and os.path.exists(reducer_file):
+        with open(reducer_file, "rb") as f:
+            state = pickle.load(f)
+        if state["sparse"] == sparse_features:
+            reducer, fitted_paths = state["reducer"], set(state["paths"])
+
+    features = feature_matrix(color_hists, sparse_features)
+    new_rows = np.array([idx for idx, path in enumerate(paths) if path not in fitted_paths], dtype=np.intp)
+    reducer, folded = fit_reducer(features, n_components_for(features, n_intermediate), sparse_features, incremental,
+                                  reducer, new_rows if reducer is not None else None)
+    linear, tsne, reduced = embed(features, reducer, n_intermediate)
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = temp_path(embedding_file)
+        np.savez(tmp, key=key, linear=linear, tsne=tsne, reduced=reduced)
+        os.replace(tmp, embedding_file)
+        if incremental:
+            if folded:
+                fitted_paths.update(paths)
+            tmp = temp_path(reducer_file)
+            with open(tmp, "wb") as f:
+                pickle.dump(dict(sparse=sparse_features, paths=sorted(fitted_paths), reducer=reducer), f)
+            os.replace(tmp, reducer_file)
+    return linear, tsne, reduced
+
+
+# KD-tree over the first n_dims components of the linear projection for the "similar images" lookup (few dimensions
+# keep the tree effective and carry most of the variance). It is pickled to cache_dir/neighbors.pkl with a hash of
+# these coordinates and only rebuilt when they change.
+def load_neighbor_index(reduced, cache_dir=None, n_dims=10):
+    coords = np.ascontiguousarray(reduced[:, :n_dims], dtype=np.float32)
+    key = hashlib.blake2b(coords.tobytes(), digest_size=16).hexdigest()
+    index_file = cache_dir and os.path.join(cache_dir, "neighbors.pkl")
+
+    if index_file and os.path.exists(index_file):
+        with open(index_file, "rb") as f:
+            state = pickle.load(f)
+        if state["key"] == key:
+            return state["tree"]
+
+    tree = KDTree(coords)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = temp_path(index_file)
+        with open(tmp, "wb") as f:
+            pickle.dump(dict(key=key, tree=tree), f)
+        os.replace(tmp, index_file)
+    return tree
+
+
+# Returns the indices and distances of the k images closest to image idx (without idx itself), nearest first.
+def similar_images(tree, idx, k):
+    data = np.asarray(tree.data)
+    dist, ind = tree.query(data[idx:idx + 1], k=min(k + 1, len(data)))
+    keep = ind[0] != idx
+    return ind[0][keep][:k], dist[0][keep][:k]
@@ -0,0 +1,345 @@
+import argparse
+import json
+import os
+import threading
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+# Helpers for the image feature extraction of main.py. They live in their own module so that bokeh serve (which runs
+# main.py as an anonymous module) can still import them.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+
+# The temporary file that is written first and then swapped in as path with os.replace. Its name is unique per process
+# and thread, so concurrent writers (other sessions or server processes) never write into each other's files.
+def temp_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "tmp_%d_%d_%s" % (os.getpid(), threading.get_ident(), name))
+
+
+# Yields the paths of all images in directory, sorted by name so every start sees them in the same order. Only the
+# names are kept in memory, not a list of the directory entries.
+def iter_images(directory):
+    yield from sorted(entry.path for entry in os.scandir(directory)
+                      if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+# Returns a zero initialized array. Arrays larger than max_bytes are not kept in RAM but in a np.memmap, either in
+# spill_path (as an .npy file) or in an anonymous temporary file.
+def allocate(shape, dtype, max_bytes=None, spill_path=None):
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if max_bytes is None or nbytes <= max_bytes:
+        return np.zeros(shape, dtype=dtype)
+    if spill_path:
+        return np.lib.format.open_memmap(spill_path, mode="w+", dtype=dtype, shape=shape)
+    return np.memmap(tempfile.TemporaryFile(), mode="w+", dtype=dtype, shape=shape)
+
+
+# Lookup tables mapping every uint8 value to its histogram bin.
+# The color bins split [0, 256) evenly, the channel bins follow np.histogram(..., range=(0, 255)), where 255 falls into
+# the last bin.
+def color_lut(n_bins):
+    return (np.arange(256) * n_bins // 256).astype(np.intp)
+
+
+def channel_lut(n_bins):
+    return np.minimum(np.arange(256) * n_bins // 255, n_bins - 1).astype(np.intp)
+
+
+# Computes the 3D color histogram (flattened to n_bins_color^3 bins) and the 3 x n_bins_channel channel histograms of
+# an (N_Pixel, 3) uint8 pixel array. Every pixel is quantized once through the lookup tables into a packed bin index,
+# so both histograms are a single np.bincount each instead of a histogramdd plus three histogram calls.
+def compute_histograms(pixels, n_bins_color, n_bins_channel):
+    pixels = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+
+    q = color_lut(n_bins_color)[pixels]
+    packed = (q[:, 0] * n_bins_color + q[:, 1]) * n_bins_color + q[:, 2]
+    color_hist = np.bincount(packed, minlength=n_bins_color ** 3)
+
+    # offset every channel by its own block of bins so that one bincount fills all three histograms
+    channel_idx = channel_lut(n_bins_channel)[pixels] + np.arange(3) * n_bins_channel
+    channel_hist = np.bincount(channel_idx.ravel(), minlength=3 * n_bins_channel).reshape(3, n_bins_channel)
+
+    return color_hist, channel_hist
+
+
+# Decodes an image into an (H, W, 3) uint8 array. With decode_scale 2, 4 or 8 the image is decoded at that fraction of
+# its size: JPEGs are downscaled by the decoder itself in the DCT domain (draft mode), which skips most of the decoding
+# work, other formats are reduced after decoding.
+def decode_image(path, decode_scale=1):
+    with Image.open(path) as im:
+        if decode_scale > 1:
+            target = (max(1, im.width // decode_scale), max(1, im.height // decode_scale))
+            im.draft("RGB", target)
+            factor = im.width // target[0]
+            if factor > 1:
+                im = im.reduce(factor)
+        return np.asarray(im.convert("RGB"))
+
+
+# Opens one image and computes its histograms. This is the worker of the process pool, so it only takes picklable
+# arguments and returns plain arrays.
+def image_features(path, n_bins_color, n_bins_channel, decode_scale=1):
+    pixels = decode_image(path, decode_scale).reshape(-1, 3)
+    color_hist, channel_hist = compute_histograms(pixels, n_bins_color, n_bins_channel)
+    # pixel counts fit into uint32, which halves what has to be sent back from the worker processes
+    return color_hist.astype(np.uint32), channel_hist.astype(np.uint32)
+
+
+# Maps worker over items in the order of items. With n_workers > 1 (or None = one per cpu) the items are fanned out to
+# a process pool; pool.map keeps the input order, so the results are the same as with a single process.
+def parallel_map(worker, items, n_workers=1, chunksize=16):
+    if n_workers is None or n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            yield from pool.map(worker, items, chunksize=chunksize)
+    else:
+        yield from map(worker, items)
+
+
+# Thumbnails are stored as thumb_dir/<w>x<h>/<image name>, one directory per size (zoom level).
+def thumbnail_path(path, thumb_dir, size):
+    return os.path.join(thumb_dir, "%dx%d" % size, os.path.basename(path))
+
+
+# The sizes whose thumbnail of path is missing or older than the image
+def outdated_thumbnails(path, thumb_dir, sizes):
+    mtime = os.stat(path).st_mtime_ns
+    return [size for size in sizes
+            if not os.path.exists(thumbnail_path(path, thumb_dir, size))
+            or os.stat(thumbnail_path(path, thumb_dir, size)).st_mtime_ns < mtime]
+
+
+# Writes the thumbnails of one image in all sizes. Thumbnails that are newer than the image are left alone, so the image
+# is only decoded if at least one of them is missing or outdated.
+def make_thumbnails(path, thumb_dir, sizes):
+    outdated = outdated_thumbnails(path, thumb_dir, sizes)
+    if not outdated:
+        return
+    with Image.open(path) as im:
+        # let the JPEG decoder downscale in the DCT domain as far as the largest thumbnail allows
+        im.draft("RGB", max(outdated))
+        im = im.convert("RGB")
+        for size in outdated:
+            out = thumbnail_path(path, thumb_dir, size)
+            tmp = temp_path(out)
+            im.resize(size, Image.BILINEAR).save(tmp, "JPEG", quality=85)
+            os.replace(tmp, out)
+
+
+# Worker of the process pool of load_features for one (path, features) item: writes the thumbnails of the image (with
+# thumb_dir, see make_thumbnails) and returns its histograms (see image_features) or None if features is False. So the
+# thumbnails are made in the same pass over the images as the features and need no process pool of their own.
+def ingest_image(item, n_bins_color, n_bins_channel, decode_scale=1, thumb_dir=None, thumb_sizes=()):
+    path, features = item
+    if thumb_dir:
+        make_thumbnails(path, thumb_dir, thumb_sizes)
+    return image_features(path, n_bins_color, n_bins_channel, decode_scale) if features else None
+
+
+# Yields the results of ingest_image for all items in the order of items, so the rows of the feature matrices (and with
+# that the embeddings) do not depend on the number of worker processes.
+def extract_features(items, n_bins_color, n_bins_channel, n_workers=1, chunksize=16, decode_scale=1, thumb_dir=None,
+                     thumb_sizes=()):
+    if thumb_dir:
+        for size in thumb_sizes:
+            os.makedirs(os.path.join(thumb_dir, "%dx%d" % size), exist_ok=True)
+    worker = partial(ingest_image, n_bins_color=n_bins_color, n_bins_channel=n_bins_channel,
+                     decode_scale=decode_scale, thumb_dir=thumb_dir, thumb_sizes=thumb_sizes)
+    yield from parallel_map(worker, items, n_workers, chunksize)
+
+
+# The feature cache is a directory with an index.json, which stores the bin numbers, the decode scale and for every
+# cached image its (size, mtime) stamp, and the two matrices color.npy (N x N_BINS_COLOR^3) and channel.npy (N x 3 x
+# N_BINS_CHANNEL), whose rows are in the order of the index. The .npy files are memory mapped when they are loaded.
+def file_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_cache(cache_dir, n_bins_color, n_bins_channel, decode_scale=1):
+    try:
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            index = json.load(f)
+        if index["n_bins_color"] != n_bins_color or index["n_bins_channel"] != n_bins_channel \
+                or index.get("decode_scale", 1) != decode_scale:
+            return None
+        color = np.load(os.path.join(cache_dir, "color.npy"), mmap_mode="r")
+        channel = np.load(os.path.join(cache_dir, "channel.npy"), mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None
+    if len(color) != len(index["files"]) or len(channel) != len(index["files"]):
+        return None
+    return index, color, channel
+
+
+# Writes the files of the cache next to the old ones and then swaps them in, so a crash never leaves a half written
+# cache behind.
+def write_cache(cache_dir, n_bins_color, n_bins_channel, decode_scale, paths, stamps, color, channel):
+    os.makedirs(cache_dir, exist_ok=True)
+    index = {"n_bins_color": n_bins_color, "n_bins_channel": n_bins_channel, "decode_scale": decode_scale,
+             "files": [[path, stamp] for path, stamp in zip(paths, stamps)]}
+    for name, array in (("color.npy", color), ("channel.npy", channel)):
+        tmp = temp_path(os.path.join(cache_dir, name))
+        # matrices that load_features spilled to disk already are a temporary .npy file of the cache
+        spilled = isinstance(array, np.memmap) and array.filename is not None \
+            and os.path.dirname(array.filename) == os.path.abspath(cache_dir) \
+            and os.path.basename(array.filename).startswith("tmp_")
+        if spilled:
+            array.flush()
+            tmp = array.filename
+        else:
+            np.save(tmp, array)
+        os.replace(tmp, os.path.join(cache_dir, name))
+    tmp = temp_path(os.path.join(cache_dir, "index.json"))
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(cache_dir, "index.json"))
+
+
+# Returns the uint32 color and channel histogram matrices of all paths (rows in the order of paths). If cache_dir is
+# given, only new or changed images (by size and mtime) are recomputed, deleted images are dropped from the cache and
+# when nothing changed at all the memory mapped matrices of the cache are returned as they are. Matrices larger than
+# max_bytes are built in a np.memmap instead of in RAM. decode_scale > 1 computes the histograms on reduced resolution
+# images, see decode_image. With thumb_dir the missing or outdated thumbnails of thumb_sizes are written by the same
+# worker processes (see ingest_image), for cached images as well.
+# on_batch(start, stop, color, channel) is called whenever rows start:stop of the matrices (and their thumbnails) are
+# complete, in row order and about batch_size rows at a time, so a caller can show images before all are processed.
+def load_features(paths, n_bins_color, n_bins_channel, cache_dir=None, n_workers=1, max_bytes=None, decode_scale=1,
+                  on_batch=None, batch_size=1024, thumb_dir=None, thumb_sizes=()):
+    paths = list(paths)
+    stamps = [file_stamp(path) for path in paths]
+    cached = read_cache(cache_dir, n_bins_color, n_bins_channel, decode_scale) if cache_dir else None
+
+    rows, unchanged = {}, False
+    if cached is not None:
+        index, cached_color, cached_channel = cached
+        rows = {path: (row, stamp) for row, (path, stamp) in enumerate(index["files"])}
+        unchanged = [[path, stamp] for path, stamp in zip(paths, stamps)] == index["files"]
+
+    # when nothing changed the matrices of the cache are used as they are
+    if unchanged:
+        color, channel, spill_paths = cached_color, cached_channel, []
+    else:
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        spill_paths = [cache_dir and temp_path(os.path.join(cache_dir, name)) for name in ("color.npy", "channel.npy")]
+        color = allocate((len(paths), n_bins_color ** 3), np.uint32, max_bytes, spill_paths[0])
+        channel = allocate((len(paths), 3, n_bins_channel), np.uint32, max_bytes, spill_paths[1])
+
+    # the rows the workers have to process, with whether their features are missing (or only their thumbnails)
+    missing = []
+    ready = np.zeros(len(paths), dtype=bool)
+    for idx, (path, stamp) in enumerate(zip(paths, stamps)):
+        row, cached_stamp = rows.get(path, (None, None))
+        if cached_stamp != stamp:
+            missing.append((idx, True))
+            continue
+        if not unchanged:
+            color[idx] = cached_color[row]
+            channel[idx] = cached_channel[row]
+        if thumb_dir and outdated_thumbnails(path, thumb_dir, thumb_sizes):
+            missing.append((idx, False))
+        else:
+            ready[idx] = True
+
+    # rows before done are complete, rows before reported were passed to on_batch
+    done = reported = 0
+    def report(force=False):
+        nonlocal done, reported
+        while done < len(paths) and ready[done]:
+            done += 1
+        if on_batch and done > reported and (force or done - reported >= batch_size):
+            for start in range(reported, done, batch_size):
+                on_batch(start, min(start + batch_size, done), color, channel)
+            reported = done
+
+    try:
+        report()
+        results = extract_features([(paths[idx], features) for idx, features in missing], n_bins_color,
+                                   n_bins_channel, n_workers, decode_scale=decode_scale, thumb_dir=thumb_dir,
+                                   thumb_sizes=thumb_sizes)
+        for (idx, features), result in zip(missing, results):
+            if features:
+                color[idx], channel[idx] = result
+            ready[idx] = True
+            report()
+        report(force=True)
+    except BaseException:
+        # the matrices never reach the cache, so their spilled temporary files are removed
+        del color, channel
+        for spill_path in spill_paths:
+            if spill_path and os.path.exists(spill_path):
+                os.remove(spill_path)
+        raise
+
+    if cache_dir and not unchanged:
+        write_cache(cache_dir, n_bins_color, n_bins_channel, decode_scale, paths, stamps, color, channel)
+    return color, channel
+
+
+# Sums the channel histograms of the selected images (all images if nothing is selected) in one NumPy reduction. If more
+# than half of the images are selected, the sum of the unselected ones is subtracted from the precomputed total of all
+# images instead, so at most half of the rows are ever read.
+def aggregate_channel_hists(channel_hists, indices, total):
+    n = len(channel_hists)
+    indices = np.asarray(indices, dtype=np.intp)
+    if len(indices) == 0 or len(indices) == n:
+        return total
+    if len(indices) <= n // 2:
+        return channel_hists[indices].sum(axis=0, dtype=np.int64)
+    unselected = np.ones(n, dtype=bool)
+    unselected[indices] = False
+    return total - channel_hists[unselected].sum(axis=0, dtype=np.int64)
+
+
+# Compares the histograms of reduced resolution decodes with the ones of the full decode for (a sample of) the images.
+# The error is the L1 distance of the normalized histograms (0 = identical, 2 = disjoint), averaged over the images,
+# together with its maximum and the decode + histogram time per image.
+def decode_error_report(paths, n_bins_color, n_bins_channel, scales=(2, 4, 8)):
+    def normalized(hist):
+        return hist / hist.sum(axis=-1, keepdims=True)
+
+    def timed(scale):
+        start = time.perf_counter()
+        results = [image_features(path, n_bins_color, n_bins_channel, scale) for path in paths]
+        per_image = (time.perf_counter() - start) / max(len(paths), 1)
+        color = np.array([normalized(c) for c, _ in results])
+        channel = np.array([normalized(h) for _, h in results])
+        return color, channel, per_image
+
+    full_color, full_channel, full_time = timed(1)
+    report = [dict(scale=1, color_mean=0.0, color_max=0.0, channel_mean=0.0, channel_max=0.0, ms=full_time * 1000)]
+    for scale in scales:
+        color, channel, per_image = timed(scale)
+        color_err = np.abs(color - full_color).sum(axis=1)
+        # mean over the three channels of every image
+        channel_err = np.abs(channel - full_channel).sum(axis=2).mean(axis=1)
+        report.append(dict(scale=scale, color_mean=color_err.mean(), color_max=color_err.max(),
+                           channel_mean=channel_err.mean(), channel_max=channel_err.max(), ms=per_image * 1000))
+    return report
+
+
+# python features.py static [--sample 200] prints the decode error report for the images of a folder
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Histogram error of reduced resolution JPEG decoding")
+    parser.add_argument("directory")
+    parser.add_argument("--sample", type=int, default=200, help="number of images to compare (evenly spaced)")
+    parser.add_argument("--bins-color", type=int, default=16)
+    parser.add_argument("--bins-channel", type=int, default=50)
+    args = parser.parse_args()
+
+    image_paths = list(iter_images(args.directory))
+    step = max(1, len(image_paths) // max(args.sample, 1))
+    image_paths = image_paths[::step][:args.sample]
+
+    print("%d images" % len(image_paths))
+    print("scale  color L1 mean/max  channel L1 mean/max  ms/image")
+    for row in decode_error_report(image_paths, args.bins_color, args.bins_channel):
+        print("1/%-4d %.4f / %.4f    %.4f / %.4f      %.1f" % (row["scale"], row["color_mean"], row["color_max"],
+                                                             row["channel_mean"], row["channel_max"], row["ms"]))
@@ -0,0 +1,103 @@
+import json
+import threading
+import traceback
+from functools import partial
+
+import numpy as np
+
+from embedding import load_embedding, load_neighbor_index, preview_projector
+from features import iter_images, load_features
+
+# Background ingestion of the images of main.py. bokeh serve runs main.py once per session but imports this module only
+# once, so the images are processed once per server process and every session subscribes to the same ingestion.
+
+
+# Processes the images of paths and passes the results to publish(kind, *args) as they become available: "batch"
+# (start, stop, coords, color, channel, batch_total) whenever the rows start:stop of the feature matrices are complete,
+# with preliminary coordinates of a running IncrementalPCA, and "embedding" (linear, tsne, index, color, channel) once
+# the final embeddings and the index for the "similar images" lookup are computed.
+def ingest(publish, paths, n_bins_color, n_bins_channel, cache_dir=None, n_workers=1, max_bytes=None, decode_scale=1,
+           thumb_dir=None, thumb_sizes=(), sparse_features=False, n_intermediate=50, incremental=False,
+           neighbor_dims=10, batch_size=1024):
+    project = preview_projector()
+
+    def on_batch(start, stop, color, channel):
+        coords = project(color[start:stop])
+        publish("batch", start, stop, coords, color, channel, channel[start:stop].sum(axis=0, dtype=np.int64))
+
+    # Compute the color and channel histograms
+    # Every image is opened with PILs Image package, converted to an (N_Pixel, 3) array and the multi dimensional color
+    # histogram (already reshaped to N_BINS_COLOR^3 columns) and a "normal" histogram for each color channel (rgb) are
+    # computed in one pass over the pixels, see features.compute_histograms. The images are spread over N_WORKERS
+    # processes but the results come back in the order of PATHS. Images that did not change since the last start are
+    # read from FEATURE_CACHE instead. The same worker processes write the thumbnails.
+    color, channel = load_features(paths, n_bins_color, n_bins_channel, cache_dir, n_workers, max_bytes, decode_scale,
+                                   on_batch, batch_size, thumb_dir, thumb_sizes)
+
+    # Calculate the indicated dimensionality reductions
+    # references:
+    # https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
+    # https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
+    # The PCA (or TruncatedSVD for sparse features) is fitted once with TSNE_INTERMEDIATE components, its first two are
+    # the PCA plot and t-SNE runs on all of them. Both embeddings are kept in FEATURE_CACHE and reused as long as the
+    # histograms and settings do not change, see embedding.load_embedding
+    linear, tsne, reduced = load_embedding(color, paths, cache_dir, sparse_features, n_intermediate, incremental)
+    # the index for the "similar images" lookup, built once and kept in FEATURE_CACHE as well
+    index = load_neighbor_index(reduced, cache_dir, neighbor_dims)
+    publish("embedding", linear, tsne, index, color, channel)
+
+
+# One run of ingest in a daemon thread. Its events are kept and subscribe(callback) first replays them to callback and
+# then passes on every new one, so a session that is opened late catches up with the others. If ingest raises, the
+# exception is passed on as an "error" event. Callbacks are called under the lock and must not block (main.py only
+# schedules them on the event loop of its session).
+class Ingestion:
+    def __init__(self, paths, run):
+        self.paths = paths
+        self.events = []
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, args=(run,), daemon=True)
+        self.thread.start()
+
+    def _run(self, run):
+        try:
+            run(self.publish)
+        except Exception as error:
+            traceback.print_exc()
+            self.publish("error", error)
+
+    def publish(self, kind, *args):
+        with self.lock:
+            # the final embedding replaces the preview, sessions that subscribe later skip the batches
+            if kind == "embedding":
+                self.events = [event for event in self.events if event[0] != "batch"]
+            self.events.append((kind, args))
+            for callback in self.subscribers:
+                callback(kind, *args)
+
+    def subscribe(self, callback):
+        with self.lock:
+            for kind, args in self.events:
+                callback(kind, *args)
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+
+_ingestions = {}
+_ingestions_lock = threading.Lock()
+
+
+# The Ingestion of the images in image_dir with these settings (the keyword arguments of ingest), started by the first
+# session that asks for it. The image list is read at that point, images added later are picked up by a restart.
+def shared_ingestion(image_dir, **settings):
+    key = json.dumps([image_dir, settings], sort_keys=True)
+    with _ingestions_lock:
+        if key not in _ingestions:
+            paths = list(iter_images(image_dir))
+            _ingestions[key] = Ingestion(paths, partial(ingest, paths=paths, **settings))
+        return _ingestions[key]
@@ -1,15 +1,18 @@
-import glob
 import os
-import numpy as np
-from PIL import Image
+from functools import partial
+from html import escape
 
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
+import numpy as np
 
 from bokeh.plotting import figure, curdoc
-from bokeh.models import ColumnDataSource, ImageURL
-from bokeh.layouts import layout,row
+from bokeh.events import Tap
+from bokeh.models import ColumnDataSource, Div, ImageURL, Range1d
+from bokeh.layouts import layout
 from bokeh.io import output_file, show, save
+
+from embedding import similar_images
+from features import aggregate_channel_hists, thumbnail_path
+from ingestion import shared_ingestion
 # Dependencies
 
 # Only do this once you've followed the rest of the instructions below and you actually reach the part where you have to
@@ -28,8 +31,8 @@ from bokeh.io import output_file, show, save
 # https://docs.bokeh.org/en/latest/docs/reference/models/selections.html#bokeh.models.selections.Selection
 
 
-# Fetch the number of images using glob or some other path analyzer
-N = len(glob.glob("static/*.jpg"))
+# Folder of the images (has to be called static for the bokeh server)
+IMAGE_DIR = "static"
 
 # Find the root directory of your app to generate the image URL for the bokeh server
 ROOT = os.path.split(os.path.abspath("."))[1] + "/"
@@ -38,88 +41,140 @@ ROOT = os.path.split(os.path.abspath("."))[1] + "/"
 N_BINS_COLOR = 16
 # Number of bins per channel for the channel histograms
 N_BINS_CHANNEL = 50
-
-# Define an array containing the 3D color histograms. We have one histogram per image each having N_BINS_COLOR^3 bins.
-# i.e. an N * N_BINS_COLOR^3 array
-# array=[[[[0 for _ in range(N_BINS_COLOR)]for _ in range(N_BINS_COLOR)]for _ in range(N_BINS_COLOR)]for img in range(N)]
-array=[[0 for _ in range(N_BINS_COLOR**3)]for img in range(N)]
-ColorHistList=np.array(array)
-# ColorHistList=array
-
-# Define an array containing the channel histograms, there is one per image each having 3 channel and N_BINS_CHANNEL
-# bins i.e an N x 3 x N_BINS_CHANNEL array
-array2=[[[0 for _ in range(N_BINS_CHANNEL)]for _ in range(3)] for img in range(N)]
-ChannelHistList=np.array(array2)
-
-# initialize an empty list for the image file paths
-URLList=[]
-# the instructions are very unclaer, I can't even get to the visualisation because of it
-
-
-# Compute the color and channel histograms
-for idx, f in enumerate(glob.glob("static/*.jpg")):
-    # open image using PILs Image package
-    im = Image.open(f)
-    # Convert the image into a numpy array and reshape it such that we have an array with the dimensions (N_Pixel, 3)
-    nArray=np.array(im)     # dim 288, 640,3
-    ordered=np.reshape(nArray, (-1,3))
-    # Compute a multi dimensional histogram for the pixels, which returns a cube        ## 3d? r,g,b
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogramdd.html
-
-    # MultiDimHist, edges=np.histogramdd(ordered, bins=(N_BINS_COLOR,N_BINS_COLOR,N_BINS_COLOR)) #wrong bin nr probl.
-    MultiDimHist, edges = np.histogramdd(ordered, bins=(N_BINS_COLOR))
-
-    # However, later used methods do not accept multi dimensional arrays, so reshape it to only have columns and rows
-    # (N_Images, N_BINS^3) and add it to the color_histograms array you defined earlier# (N, N_BINS_COLOR^3)
-    ColorHistList[idx] = np.reshape(MultiDimHist, (1, N_BINS_COLOR ** 3))
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.reshape.html
-
-    # Append the image url to the list for the server
-    url = ROOT + f
-    URLList.append(url)
-    # Compute a "normal" histogram for each color channel (rgb)
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-    ordered=np.array(ordered).T.tolist()# transpose
-
-    r, edges=np.histogram(ordered[0],bins=N_BINS_CHANNEL, range=(0, 255))
-    g, edges=np.histogram(ordered[1], bins=N_BINS_CHANNEL, range=(0, 255))
-    b, edges=np.histogram(ordered[2], bins=N_BINS_CHANNEL, range=(0, 255))
-    # and add them to the channel_histograms
-    ChannelHistList[idx][0]=r
-    ChannelHistList[idx][1] = g
-    ChannelHistList[idx][2] = b
-
-# Calculate the indicated dimensionality reductions
-# references:
-# https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
-
-X_embedded = TSNE(n_components=2).fit_transform(ColorHistList)
-
-# https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
-pca = PCA(n_components=2)
-pca.fit_transform(ColorHistList)
-array=pca.transform(ColorHistList)
+# Number of processes used to decode the images and compute the histograms (None = one per cpu, 1 = no process pool)
+N_WORKERS = None
+# Decode the images at 1/DECODE_SCALE of their size (1, 2, 4 or 8) before computing the histograms. JPEG decoding is
+# the most expensive part of the ingestion; run "python features.py static" to see the histogram error of each scale
+DECODE_SCALE = 1
+# Directory of the on disk feature cache, so a restart only recomputes the histograms of new or changed images
+# (None disables the cache)
+FEATURE_CACHE = "cache"
+# Feature matrices larger than this (in bytes) are kept in a np.memmap on disk instead of in RAM
+MAX_FEATURE_MEMORY = 2 * 1024 ** 3
+# The image glyphs show small thumbnails instead of the full images. The first size is shown by default, the second
+# (optional) one once a plot is zoomed in more than ZOOM_THRESHOLD times. Thumbnails are only rebuilt for changed
+# images.
+THUMB_DIR = os.path.join(IMAGE_DIR, "thumbs")
+THUMB_SIZES = [(100, 80), (400, 320)]
+ZOOM_THRESHOLD = 4
+# Keep the color histograms as a sparse (CSR) matrix and use TruncatedSVD instead of PCA for the linear projection
+SPARSE_FEATURES = False
+# Number of components of the linear projection t-SNE runs on (None = t-SNE on the raw N_BINS_COLOR^3 histograms)
+TSNE_INTERMEDIATE = 50
+# Use an IncrementalPCA that folds newly added images into the projection of the last start instead of refitting it
+INCREMENTAL_PCA = False
+# Number of similar images shown when a single image is clicked, found with a KD-tree over the first NEIGHBOR_DIMS
+# components of the PCA
+N_SIMILAR = 8
+NEIGHBOR_DIMS = 10
+# The images are processed in a background thread after the page is served and shown in batches of this many images
+# (first at preliminary PCA coordinates, the t-SNE plot switches to the t-SNE coordinates once they are computed)
+STREAM_BATCH = 1024
+
+doc = curdoc()
+
+# The images are processed once per server process, every session subscribes to the same ingestion (see the end of
+# this file and ingestion.py)
+ingestion = shared_ingestion(IMAGE_DIR, n_bins_color=N_BINS_COLOR, n_bins_channel=N_BINS_CHANNEL,
+                             cache_dir=FEATURE_CACHE, n_workers=N_WORKERS, max_bytes=MAX_FEATURE_MEMORY,
+                             decode_scale=DECODE_SCALE, thumb_dir=THUMB_DIR, thumb_sizes=THUMB_SIZES,
+                             sparse_features=SPARSE_FEATURES, n_intermediate=TSNE_INTERMEDIATE,
+                             incremental=INCREMENTAL_PCA, neighbor_dims=NEIGHBOR_DIMS, batch_size=STREAM_BATCH)
+
+# Fetch the image paths and the number of images
+# (sorted, so every start sees the images in the same order and the embeddings are reproducible)
+PATHS = ingestion.paths
+N = len(PATHS)
+
+# the lists for the thumbnail file paths (the image urls for the server), one per zoom level. The thumbnails themselves
+# are created by the ingestion, together with the features of the images
+URLList = [ROOT + thumbnail_path(f, THUMB_DIR, THUMB_SIZES[0]) for f in PATHS]
+ZoomURLList = [ROOT + thumbnail_path(f, THUMB_DIR, THUMB_SIZES[-1]) for f in PATHS]
 
 # Construct a data source containing the dimensional reduction result for both the t-SNE and the PCA and the image paths
+# It starts empty and is filled with source.stream while the images are processed, see the ingestion below
 
 source = ColumnDataSource(data=dict(
-    TSNE1=[X_embedded[n][0] for n in range(121)],
-    TSNE2=[X_embedded[n][1] for n in range(121)],
-    PCA1=[array[n][0] for n in range(121)],
-    PCA2=[array[n][1] for n in range(121)],
-    Paths=URLList,
+    TSNE1=[],
+    TSNE2=[],
+    PCA1=[],
+    PCA2=[],
+    Paths=[],
+    PathsZoom=[],
     )
 )
+
+# The feature matrices and what is derived from them, set by the ingestion
+# ColorHistList is the N * N_BINS_COLOR^3 array of the 3D color histograms, ChannelHistList the N x 3 x N_BINS_CHANNEL
+# array of the channel histograms. Both always have all N rows, but only the first len(source.data["Paths"]) rows belong
+# to images that are shown already, the others are zero or already filled from the feature cache.
+ColorHistList = np.zeros((0, N_BINS_COLOR ** 3), dtype=np.uint32)
+ChannelHistList = np.zeros((0, 3, N_BINS_CHANNEL), dtype=np.uint32)
+# sum of the channel histograms of all images shown so far
+channelTotal = np.zeros((3, N_BINS_CHANNEL), dtype=np.int64)
+# the index for the "similar images" lookup (None until the embedding is done)
+neighborIndex = None
+
+# Switches the url column of an image glyph to the larger thumbnails once its plot is zoomed in far enough, i.e. once
+# the visible x range is less than 1/ZOOM_THRESHOLD of the extent of the x column of the data. The glyph (sized in
+# screen units) is then drawn larger by the size ratio of the two thumbnail sizes, so their extra pixels are actually
+# shown. The extent is computed again whenever the data changes (preview batches, the final embedding), so every
+# embedding is compared on its own scale.
+def connect_zoom_level(plot, image):
+    extent = []
+    baseSize = (image.w, image.h)
+    scale = THUMB_SIZES[-1][0] / THUMB_SIZES[0][0]
+    def callback(attr, old, new):
+        if plot.x_range.start is None or plot.x_range.end is None or len(source.data[image.x]) == 0:
+            return
+        if not extent:
+            extent.append(np.ptp(np.asarray(source.data[image.x], dtype=np.float64)))
+        span = plot.x_range.end - plot.x_range.start
+        zoomed = span * ZOOM_THRESHOLD < extent[0]
+        url = "PathsZoom" if zoomed else "Paths"
+        if image.url != url:
+            factor = scale if zoomed else 1
+            image.update(url=url, w=baseSize[0] * factor, h=baseSize[1] * factor)
+    def data_changed(attr, old, new):
+        extent.clear()
+        callback(attr, old, new)
+    plot.x_range.on_change("end", callback)
+    source.on_change("data", data_changed)
+
+# Selects the image under a click on the plot, which shows its most similar images below the plots. Several images may
+# overlap there, the one whose center is closest to the click (in screen pixels) wins; a click next to all images clears
+# the selection. (A tap tool would select every overlapping circle, which is no single image in dense layouts.)
+def connect_tap(plot, image):
+    def callback(event):
+        if plot.x_range.start is None or plot.y_range.start is None or len(source.data[image.x]) == 0:
+            return
+        # pixels per data unit (the plot size is reported by the browser, without it the ranges are compared)
+        try:
+            width, height = plot.inner_width, plot.inner_height
+        except ValueError:
+            width = height = None
+        dx = np.abs(np.asarray(source.data[image.x], dtype=np.float64) - event.x) \
+            * (width or 1) / abs(plot.x_range.end - plot.x_range.start)
+        dy = np.abs(np.asarray(source.data[image.y], dtype=np.float64) - event.y) \
+            * (height or 1) / abs(plot.y_range.end - plot.y_range.start)
+        hit = np.arange(len(dx))
+        if width and height:
+            hit = np.flatnonzero((dx <= image.w / 2) & (dy <= image.h / 2))
+        source.selected.indices = [int(hit[np.argmin(dx[hit] ** 2 + dy[hit] ** 2)])] if len(hit) else []
+    plot.on_event(Tap, callback)
 #_____________________________________________________________________________________________________________________________________________________________________
 # Create a first figure for the t-SNE data. Add the lasso_select, wheel_zoom, pan and reset tools to it.
+# (a click selects a single image, which shows its most similar images below the plots, see connect_tap)
 TOOLS = "box_select,lasso_select,wheel_zoom,pan,reset,help"
-p=figure(title='t-sne',tools=TOOLS)
+p=figure(title='t-sne (PCA preview while loading)',tools=TOOLS)
 p.yaxis.axis_label = "y"
 p.xaxis.axis_label = "x"
 
 # image1 = ImageURL(url=URLList[0], x=X_embedded[0][0], y=X_embedded[0][1], w=300, h=300, anchor="center")
 image = ImageURL(url="Paths", x="TSNE1", y="TSNE2", w=100, h=80, anchor="center",h_units="screen",w_units="screen")
 p.add_glyph(source, image)
+connect_zoom_level(p, image)
+connect_tap(p, image)
 
 p.sizing_mode = "stretch_both"
 
@@ -142,43 +197,28 @@ p2.xaxis.axis_label = "x"
 
 image2 = ImageURL(url="Paths", x="PCA1", y="PCA2", w=80, h=60, anchor="center",h_units="screen",w_units="screen")
 p2.add_glyph(source, image2)
+connect_zoom_level(p2, image2)
+connect_tap(p2, image2)
 
 p2.sizing_mode = "stretch_both"
 p2.circle(x="PCA1", y="PCA2",size=1,fill_color="white",fill_alpha=0,line_alpha=0, source=source)
 #____________________________________________________________________________________________________________________________________________________________________________
 # Construct a datasource containing the channel histogram data. Default value should be the selection of all images.
 # Think about how you aggregate the histogram data of all images to construct this data source
-ImUntalented=[]
-for i in range(1,51):
-    ImUntalented.append(i)
-
-rAgg=np.zeros((N_BINS_CHANNEL))
-for i in range(1,N):
-    for y in range(N_BINS_CHANNEL):
-        if ChannelHistList[i][0][y]>0:
-            # rAgg[y] +=1
-            rAgg[y]+=ChannelHistList[i][0][y]
-
-gAgg=np.zeros((N_BINS_CHANNEL))
-for i in range(1,N):
-    for y in range(N_BINS_CHANNEL):
-        if ChannelHistList[i][1][y]>0:
-            # gAgg[y] +=1
-            gAgg[y]+=ChannelHistList[i][1][y]
-
-bAgg=np.zeros((N_BINS_CHANNEL))
-for i in range(0,N):
-    for y in range(N_BINS_CHANNEL):
-        if ChannelHistList[i][2][y]>0:
-            # bAgg[y] +=1
-            bAgg[y]+=ChannelHistList[i][2][y]
-
-sourceHist = ColumnDataSource(data=dict(
-    x=ImUntalented,
-    r=np.divide(rAgg, max(rAgg.max(),max(bAgg.max(),gAgg.max()))),
-    g=np.divide(gAgg,  max(rAgg.max(),max(bAgg.max(),gAgg.max()))),
-    b=np.divide(bAgg,  max(rAgg.max(),max(bAgg.max(),gAgg.max())))
-))
+# The sum over all images is kept up to date while they are loaded, the selection callback below only sums the selected
+# (or unselected) rows
+
+def histogram_data(agg):
+    # normalize all three channels by the same maximum so they stay comparable
+    norm = max(agg.max(), 1)
+    return dict(
+        x=np.arange(1, N_BINS_CHANNEL + 1),
+        r=agg[0] / norm,
+        g=agg[1] / norm,
+        b=agg[2] / norm,
+    )
+
+sourceHist = ColumnDataSource(data=histogram_data(channelTotal))
 # Construct a histogram plot with three lines.
 # First define a figure and then make three line plots on it, one for each color channel.
 # Add the wheel_zoom, pan and reset tools to it.
@@ -194,9 +234,80 @@ p3.sizing_mode = "stretch_both"
 
 # Connect the on_change routine of the selected attribute of the dimensionality reduction ColumnDataSource with a
 # callback/update function to recompute the channel histogram. Also read the topmost comment for more information.
+def update_histogram(attr, old, new):
+    shown = ChannelHistList[:len(source.data["Paths"])]
+    sourceHist.data = histogram_data(aggregate_channel_hists(shown, new, channelTotal))
+
+source.selected.on_change("indices", update_histogram)
+#____________________________________________________________________________________________________________________________________________________________________________
+# A row of the N_SIMILAR images closest (by color histogram) to the image that was clicked last
+sourceSimilar = ColumnDataSource(data=dict(x=[], Paths=[], dist=[]))
+p4 = figure(title='Similar images', x_range=Range1d(-0.5, N_SIMILAR - 0.5), y_range=Range1d(-0.5, 0.5),
+            tools="", toolbar_location=None, height=150)
+p4.axis.visible = False
+p4.grid.visible = False
+p4.add_glyph(sourceSimilar, ImageURL(url="Paths", x="x", y=0, w=0.95, h=0.95, anchor="center"))
+p4.sizing_mode = "stretch_width"
+
+def update_similar(attr, old, new):
+    if len(new) != 1 or neighborIndex is None:
+        return
+    ind, dist = similar_images(neighborIndex, new[0], N_SIMILAR)
+    sourceSimilar.data = dict(x=np.arange(len(ind)), Paths=[URLList[i] for i in ind], dist=dist)
+
+source.selected.on_change("indices", update_similar)
+
+# shows an error of the ingestion
+statusDiv = Div(text="", sizing_mode="stretch_width")
 
 # Construct a layout and use curdoc() to add it to your document.
-curdoc().add_root(row(p, p2, p3))
+doc.add_root(layout([[p, p2, p3], [p4], [statusDiv]], sizing_mode="stretch_both"))
+#____________________________________________________________________________________________________________________________________________________________________________
+# The ingestion runs in a background thread (see ingestion.py), so the page is served right away. Its events must not
+# touch the document directly, all updates go through add_next_tick_callback and run on the server's event loop.
+
+# Appends the images start:stop to the plots (called on the event loop)
+def stream_batch(start, stop, coords, color, channel, batchTotal):
+    global ColorHistList, ChannelHistList, channelTotal
+    ColorHistList, ChannelHistList = color, channel
+    channelTotal = channelTotal + batchTotal
+    source.stream(dict(
+        TSNE1=coords[:, 0],
+        TSNE2=coords[:, 1],
+        PCA1=coords[:, 0],
+        PCA2=coords[:, 1],
+        Paths=URLList[start:stop],
+        PathsZoom=ZoomURLList[start:stop],
+    ))
+    if not source.selected.indices:
+        sourceHist.data = histogram_data(channelTotal)
+
+# Replaces the preview coordinates with the final PCA and t-SNE embeddings (called on the event loop)
+def show_embedding(array, X_embedded, index, color, channel):
+    global ColorHistList, ChannelHistList, channelTotal, neighborIndex
+    ColorHistList, ChannelHistList, neighborIndex = color, channel, index
+    channelTotal = ChannelHistList.sum(axis=0, dtype=np.int64)
+    source.data = dict(
+        TSNE1=X_embedded[:, 0],
+        TSNE2=X_embedded[:, 1],
+        PCA1=array[:, 0],
+        PCA2=array[:, 1],
+        Paths=URLList,
+        PathsZoom=ZoomURLList,
+    )
+    p.title.text = 't-sne'
+    update_histogram("indices", None, source.selected.indices)
+
+def show_error(error):
+    statusDiv.text = "<b>Loading the images failed:</b> " + escape(repr(error))
+
+eventHandlers = dict(batch=stream_batch, embedding=show_embedding, error=show_error)
+
+def on_ingestion_event(kind, *args):
+    doc.add_next_tick_callback(partial(eventHandlers[kind], *args))
+
+ingestion.subscribe(on_ingestion_event)
+doc.on_session_destroyed(lambda context: ingestion.unsubscribe(on_ingestion_event))
 
 # You can use the command below in the folder of your python file to start a bokeh directory app.
 # Be aware that your python file must be named main.py and that your images have to be in a subfolder name "static"
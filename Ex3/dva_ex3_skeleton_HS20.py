@@ -1,150 +1,213 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import numpy as np
-from bokeh.models import ColumnDataSource, Button, Select, Div
+import pandas as pd
+from bokeh.models import ColumnDataSource, Button, Select, Div, MultiChoice, Spinner, Toggle
+from bokeh.palettes import Category10, Category20, turbo
 from bokeh.sampledata.iris import flowers
 from bokeh.plotting import figure, curdoc
 from bokeh.layouts import column, row
 
+from kmedoids import Distances, clara, k_medoids as run_k_medoids, multi_restart, nearest_medoids
+from results import data_fingerprint, result_cache, result_key
+
 # Important: You must also install pandas for the data import.
 
-# calculate the cost of the current medoid configuration
-# The cost is the sum of all minimal distances of all points to the closest medoids
-def get_cost(meds):
-    distsum = 0
-    for i in range(data.shape[0]):
-        point = np.array(data.iloc[i])
-        dist1 = (abs(meds[0] - point)).sum()
-        dist2 = (abs(meds[1] - point)).sum()
-        dist3 = (abs(meds[2] - point)).sum()
+# CSV file to cluster instead of the iris flowers (its first four numeric columns are plotted like the iris columns)
+DATA_FILE = None
+# Above this many rows the dashboard defaults to CLARA instead of PAM (which needs the n x n distances)
+PAM_LIMIT = 5000
+# CLARA runs PAM on CLARA_SAMPLES random samples of CLARA_SAMPLE_SIZE rows
+CLARA_SAMPLES = 5
+CLARA_SAMPLE_SIZE = 1000
+# At most this many (randomly chosen) points are drawn in the scatter plots. Streamed points are always drawn, the
+# oldest drawn points make room for them
+PLOT_POINTS = 20000
+# Memory budget (in bytes) of the distance computations. The n x n distance matrix is only precomputed if it fits,
+# otherwise distances are computed in blocks of this size
+MAX_DISTANCE_MEMORY = 256 * 1024 ** 2
+# Random medoids run this many restarts (default of the dashboard) on RESTART_WORKERS processes (None: all cores)
+N_RESTARTS = 16
+RESTART_WORKERS = None
+# Clustering results are cached (shared by all sessions of the server) for the last RESULT_CACHE_SIZE settings, and also
+# stored in RESULT_CACHE_DIR if it is set
+RESULT_CACHE_SIZE = 32
+RESULT_CACHE_DIR = None
+# Streaming mode: every STREAM_INTERVAL milliseconds STREAM_BATCH new points (read from STREAM_FILE, or simulated
+# measurements that drift by STREAM_DRIFT standard deviations per batch) are assigned to the current medoids and added
+# to the plots. The data is only clustered again when the mean cost of the new points exceeds the mean cost of the
+# clustering by more than DRIFT_THRESHOLD (relative)
+STREAM_FILE = None
+STREAM_BATCH = 50
+STREAM_INTERVAL = 1000
+STREAM_DRIFT = 0.01
+DRIFT_THRESHOLD = 0.2
+# Minimal time (in seconds) between two progress updates of the plots while clustering
+PROGRESS_INTERVAL = 0.2
+
+# The clustering runs in a worker thread so the server keeps handling events (of this and every other session) while
+# it runs. The worker never touches the document itself, all updates go through add_next_tick_callback.
+doc = curdoc()
+executor = ThreadPoolExecutor(max_workers=1)
+cancelEvent = threading.Event()
+results = result_cache(RESULT_CACHE_SIZE, RESULT_CACHE_DIR)
+
+# The distances of points (a snapshot of data) for the selected features and metric, recomputed only when one of them
+# or the number of points changes. data only grows, so its first n rows are the same in every snapshot of n rows.
+distanceCache = {}
+
+def get_distances(points, featureCols, metricName):
+    key = (tuple(featureCols), metricName, len(points))
+    distances = distanceCache.get(key)
+    if distances is None:
+        distances = Distances(points[list(featureCols)].to_numpy(dtype=np.float32), metricName.lower(),
+                              MAX_DISTANCE_MEMORY)
+        distanceCache.clear()
+        distanceCache[key] = distances
+    return distances
+
+# The fingerprints (see results.data_fingerprint) of the data of every selected feature combination
+fingerprintCache = {}
+
+def get_fingerprint(featureCols):
+    key = tuple(featureCols)
+    if key not in fingerprintCache:
+        fingerprintCache[key] = data_fingerprint(data[list(featureCols)].to_numpy(dtype=np.float32))
+    return fingerprintCache[key]
+
+# one color per cluster
+def cluster_colors(k):
+    if k <= 3:
+        return ["red", "green", "blue"][:k]
+    if k <= 10:
+        return list(Category10[10][:k])
+    if k <= 20:
+        return list(Category20[20][:k])
+    return list(turbo(k))
+
+# The settings of the dashboard, read on the event loop when the button is clicked
+def current_settings():
+    return dict(k=int(kInput.value), random=source.data["Random"][0], algorithm=algorithm.value,
+                features=list(features.value), metric=metric.value, restarts=int(restartsInput.value),
+                init=init.value, seed=int(seedInput.value))
+
+# The key of the clustering result of these settings; settings that are not used (e.g. the restarts without random
+# medoids) are left out, so they do not cause cache misses
+def settings_key(settings):
+    params = dict(k=settings["k"], metric=settings["metric"], algorithm=settings["algorithm"],
+                  random=settings["random"])
+    if settings["algorithm"] == "CLARA":
+        params.update(samples=CLARA_SAMPLES, sample_size=CLARA_SAMPLE_SIZE)
+    if settings["random"]:
+        params.update(seed=settings["seed"])
+        if settings["algorithm"] != "CLARA":
+            params.update(restarts=settings["restarts"], init=settings["init"])
+    return result_key(get_fingerprint(settings["features"]), **params)
 
-        distsum += min(dist1, min(dist2, dist3))
-    return distsum  # total cost
+# Colors the plotted points by the cluster labels of the first len(labels) rows of data and shows the cost (runs on the
+# event loop). Plotted points that were streamed in after these rows keep their color.
+def show_clustering(labels, cost, k, text):
+    colors = np.array(cluster_colors(k))
+    shown = np.array(source.data["colors"], dtype=object)
+    clustered = plotRows < len(labels)
+    shown[clustered] = colors[labels[plotRows[clustered]]]
+    source.data["colors"] = shown.tolist()
+    div.text = str("%s: %.2f" % (text, cost))
 
-def k_medoids(source):  # dont know if i can add params
+# Runs in the worker thread on points, the data when the clustering was started (stream_points replaces data meanwhile).
+# Returns the medoids, the labels, the final cost and the costs of all restarts (None without restarts).
+def k_medoids(settings, points):
     # number of clusters:
-    k = 3
+    k = settings["k"]
+    distances = get_distances(points, settings["features"], settings["metric"])
     # Use the following medoids if random medoid is set to false in the dashboard. These numbers are indices into the
-    # data array.
-    random = source.data["Random"][0]
-    if random:
-        rand1 = np.random.random_integers(data.shape[0])
-        rand2 = np.random.random_integers(data.shape[0])
-        while rand2 == rand1:
-            rand2 = np.random.random_integers(data.shape[0])
-        rand3 = np.random.random_integers(data.shape[0])
-        while rand3 == rand1 or rand3 == rand2:
-            rand3 = np.random.random_integers(data.shape[0])
-
-        medoids = [rand1, rand2, rand3]
-        meds = [data.iloc[medoids[y]] for y in range(len(medoids))]
+    # data array. (for another k or dataset a fixed seed picks them)
+    random = settings["random"]
+    if k == 3 and not DATA_FILE:
+        medoids = [24, 74, 124]
+    else:
+        medoids = np.random.default_rng(0).choice(len(distances), k, replace=False)
+
+    # pushes the clustering of the current iteration to the plots, at most every PROGRESS_INTERVAL seconds
+    lastUpdate = [0.0]
+    def progress(medoids, labels, cost):
+        now = time.monotonic()
+        if now - lastUpdate[0] >= PROGRESS_INTERVAL:
+            lastUpdate[0] = now
+            doc.add_next_tick_callback(partial(show_clustering, np.array(labels), cost, k, "Current cost"))
 
+    costs = None
+    if settings["algorithm"] == "CLARA":
+        # PAM on random samples, scored on all rows; the seed is fixed unless random medoids are chosen
+        medoids, labels, costNew = clara(distances.data, k, CLARA_SAMPLES, CLARA_SAMPLE_SIZE,
+                                         settings["seed"] if random else 0, MAX_DISTANCE_MEMORY, distances.metric,
+                                         progress, cancelEvent)
+    elif random:
+        # the best of several seeded random (or k-medoids++) starts, run in parallel processes
+        medoids, labels, costNew, costs = multi_restart(distances, k, settings["restarts"], settings["seed"],
+                                                        settings["init"].lower(), RESTART_WORKERS,
+                                                        callback=progress, cancel=cancelEvent)
     else:
-        medoids = [24, 74, 124]
-        meds = [data.iloc[medoids[y]] for y in range(len(medoids))]
-
-    meds = np.array(meds)
-    costOld = get_cost(meds)
-    better = True
-    while better:
-        # assigning points to medoids
-        Team1 = []
-        Team2 = []
-        Team3 = []
-        for i in range(data.shape[0]):
-            point = np.array(data.iloc[i])
-            dist1 = (abs(meds[0] - point)).sum()
-            dist2 = (abs(meds[1] - point)).sum()
-            dist3 = (abs(meds[2] - point)).sum()
-
-            if dist1 < dist2 and dist1 < dist3:
-                Team1.append(i)
-
-            elif dist2 < dist1 and dist2 < dist3:
-                Team2.append(i)
-
-            else:
-                Team3.append(i)
-
-        # recalc the medoids
-        # med1
-        bestMedi1 = medoids[0]
-        bestCost1 = costOld
-        for i in range(len(Team1)):
-            currcost = get_cost(np.array([data.iloc[Team1[i]], meds[1], meds[2]]))
-            if bestCost1 > currcost:
-                bestMedi1 = Team1[i]
-                bestCost1 = currcost
-
-        # med2
-        bestMedi2 = medoids[1]
-        bestCost2 = costOld
-        for i in range(len(Team2)):
-            currcost = get_cost(np.array([meds[0], data.iloc[Team2[i]], meds[2]]))
-            if bestCost2 > currcost:
-                bestMedi2 = Team2[i]
-                bestCost2 = currcost
-
-        # med3
-        bestMedi3 = medoids[2]
-        bestCost3 = costOld
-        for i in range(len(Team3)):
-            currcost = get_cost(np.array([meds[0], meds[1], data.iloc[Team3[i]]]))
-            if bestCost3 > currcost:
-                bestMedi3 = Team3[i]
-                bestCost3 = currcost
-
-        if bestCost1 < bestCost2 and bestCost1 < bestCost3:
-            medoids = [bestMedi1, medoids[1], medoids[2]]
-        elif bestCost2 < bestCost1 and bestCost2 < bestCost3:
-            medoids = [medoids[0], bestMedi2, medoids[2]]
-        else:
-            medoids = [medoids[0], medoids[1], bestMedi3]
-
-        meds = [data.iloc[medoids[y]] for y in range(len(medoids))]
-        meds = np.array(meds)
-
-        # check if it got better
-        costNew = get_cost(meds)
-        if costNew < costOld:
-            better = True
-        else:
-            better = False
-        costOld = costNew
-        # print(costOld)    # for testing
-
-    newList = [0 for _ in range(data.shape[0])]
-    for i in Team1:
-        newList[i] = "red"
-    for i in Team2:
-        newList[i] = "green"
-    for i in Team3:
-        newList[i] = "blue"
-    source.data["colors"] = newList
-    return costNew
+        # assigning the points to the medoids and evaluating the swaps of medoids with other points is done on the
+        # precomputed distance matrix, see kmedoids.k_medoids
+        medoids, labels, costNew = run_k_medoids(distances, medoids, callback=progress, cancel=cancelEvent)
+
+    return medoids, labels, costNew, costs
 
 # read and store the dataset
-data = flowers.copy(deep=True)
-data = data.drop(['species'], axis=1)
+if DATA_FILE:
+    data = pd.read_csv(DATA_FILE).select_dtypes("number")
+else:
+    data = flowers.copy(deep=True)
+    data = data.drop(['species'], axis=1)
+
+# the rows shown in the scatter plots, a random subset for large datasets
+if len(data) > PLOT_POINTS:
+    plotRows = np.sort(np.random.default_rng(0).choice(len(data), PLOT_POINTS, replace=False))
+else:
+    plotRows = np.arange(len(data))
+
+# The columns of data behind the plotted fields (named after the iris columns), the first four columns of a DATA_FILE
+plotColumns = dict(sepalL=data.columns[0], sepalW=data.columns[1], petalL=data.columns[2], petalW=data.columns[3])
+
+# axis label of a plotted field, e.g. "Petal length" for the column petal_length
+def axis_label(field):
+    name = str(plotColumns[field]).replace("_", " ")
+    return name[:1].upper() + name[1:]
+
+# the range of a plotted field: the minimum and maximum of its column, padded by 5% of their difference
+def axis_range(field):
+    values = data[plotColumns[field]]
+    pad = 0.05 * (values.max() - values.min())
+    return float(values.min() - pad), float(values.max() + pad)
+
+def plot_title(xField, yField):
+    return "Scatterplot of %s by %s and %s" % (DATA_FILE or "Flower distribution", axis_label(xField).lower(),
+                                               axis_label(yField).lower())
 
 # create a color column in your dataframe and set it to gray on startup
-df = data.copy()
+df = data.iloc[plotRows].copy()
 df["color"] = "darkgrey"
-random = [False for _ in range(data.shape[0])]
+random = [False for _ in range(df.shape[0])]
 # Create a ColumnDataSource from the data
 source = ColumnDataSource(data=dict(
-    sepalL=df.iloc[:, 0],
-    sepalW=df.iloc[:, 1],
-    petalL=df.iloc[:, 2],
-    petalW=df.iloc[:, 3],
-    colors=df.iloc[:, 4],
+    sepalL=df[plotColumns["sepalL"]],
+    sepalW=df[plotColumns["sepalW"]],
+    petalL=df[plotColumns["petalL"]],
+    petalW=df[plotColumns["petalW"]],
+    colors=df["color"],
     Random=random  # just to have a var which can change at runtime
     )
 )
 # k_medoids(source) # for testing
 
 # Create a select widget, a button, a DIV to show the final clustering cost and two figures for the scatter plots.
-p = figure(title='Scatterplot of Flower distribution by petal length and sepal length', x_range=(1, 7))
-p.xaxis.axis_label = "Petal length"
-p.yaxis.axis_label = "Sepal length"
+p = figure(title=plot_title("petalL", "sepalL"), x_range=axis_range("petalL"))
+p.xaxis.axis_label = axis_label("petalL")
+p.yaxis.axis_label = axis_label("sepalL")
 p.scatter("petalL", "sepalL", fill_color="colors", line_color="colors", fill_alpha=.7, source=source)
 # ______________________________________________________________________________________________________________________
 select = Select(title="Random Medoids", value="False", options=["True", "False"])
@@ -157,25 +220,182 @@ def callback(attr, old, new):
         source.data["Random"][0] = False
 
 select.on_change("value", callback)
+# PAM on the full distance matrix or CLARA (sampling based, for large datasets)
+algorithm = Select(title="Algorithm", value="PAM" if len(data) <= PAM_LIMIT else "CLARA", options=["PAM", "CLARA"])
+# number of clusters, distance metric and the columns the clustering uses
+kInput = Spinner(title="Number of clusters (k)", low=2, high=50, step=1, value=3)
+metric = Select(title="Distance metric", value="L1", options=["L1", "L2", "cosine"])
+features = MultiChoice(title="Features", value=list(data.columns), options=list(data.columns))
+# restarts of the random medoids, their initialization and the seed the restarts are drawn from
+restartsInput = Spinner(title="Restarts (random medoids)", low=1, high=256, step=1, value=N_RESTARTS)
+init = Select(title="Initialization", value="Random", options=["Random", "k-medoids++"])
+seedInput = Spinner(title="Seed", low=0, step=1, value=0)
 # ______________________________________________________________________________________________________________________
 button = Button(label="Cluster Data", button_type="primary")
 
 def handler():
-    cost = k_medoids(source)
-    div.text = str("The final cost is: %.2f" % cost)
+    if not features.value:
+        div.text = "Select at least one feature"
+        return
+    start_clustering(current_settings())
+
+def start_clustering(settings):
+    settings["key"] = settings_key(settings)
+    cached = results.get(settings["key"])
+    if cached is not None:
+        show_result(settings, *cached, cancelled=False)
+        return
+    cancelEvent.clear()
+    button.disabled = True
+    cancelButton.disabled = False
+    div.text = "Clustering..."
+    # the data that settings_key fingerprinted above
+    future = executor.submit(k_medoids, settings, data)
+    future.add_done_callback(lambda f: doc.add_next_tick_callback(partial(finished, settings, f)))
+
+# called on the event loop once the worker is done (or was cancelled)
+def finished(settings, future):
+    button.disabled = False
+    cancelButton.disabled = True
+    try:
+        medoids, labels, cost, costs = future.result()
+    except Exception as e:
+        div.text = "Clustering failed: %s" % e
+        return
+    cancelled = cancelEvent.is_set()
+    if not cancelled:
+        results.put(settings["key"], medoids, labels, cost, costs)
+    show_result(settings, medoids, labels, cost, costs, cancelled)
+
+def show_result(settings, medoids, labels, cost, costs, cancelled):
+    # the baseline of the drift detection of the streaming mode
+    clustering.update(settings=settings, medoids=np.asarray(medoids), meanCost=cost / len(labels), streamed=0,
+                      streamedCost=0.0)
+    # points that were streamed in while the clustering ran are assigned to its medoids
+    if len(labels) < len(data):
+        labels = np.concatenate([labels, assign_new(data.iloc[len(labels):])[0]])
+    show_clustering(labels, cost, settings["k"], "Cancelled, the cost is" if cancelled else "The final cost is")
+    if costs is not None:
+        costs = costs[~np.isnan(costs)]
+        div.text += "<br>%d restarts, cost min / median / max: %.2f / %.2f / %.2f" % (
+            len(costs), costs.min(), np.median(costs), costs.max())
 
 button.on_click(handler)
+
+cancelButton = Button(label="Cancel", button_type="warning", disabled=True)
+
+def cancel_handler():
+    cancelEvent.set()
+    div.text = "Cancelling..."
+
+cancelButton.on_click(cancel_handler)
+# ______________________________________________________________________________________________________________________
+# streaming of new points
+
+# The last clustering (medoids, settings and mean cost) and the number and total cost of the points streamed since
+clustering = {}
+
+# Batches of new points (data frames with the columns of data)
+def incoming_batches(known):
+    if STREAM_FILE:
+        for chunk in pd.read_csv(STREAM_FILE, chunksize=STREAM_BATCH):
+            yield chunk[known.columns]
+        return
+    # simulated measurements: jittered copies of random known points that slowly drift away from them
+    rng = np.random.default_rng(0)
+    points = known.to_numpy(dtype=np.float64)
+    std = points.std(axis=0)
+    step = 0
+    while True:
+        step += 1
+        rows = points[rng.choice(len(points), STREAM_BATCH)]
+        rows = rows + rng.normal(0, 0.1, rows.shape) * std + step * STREAM_DRIFT * std
+        yield pd.DataFrame(rows, columns=known.columns)
+
+incoming = incoming_batches(data)
+
+# The values of data once points are streamed in. The array grows by doubling and data is a view of its filled rows, so
+# a batch only copies its own rows (and now and then the whole array once) instead of concatenating the whole frame.
+dataValues = None
+
+def append_rows(batch):
+    global data, dataValues
+    n = len(data)
+    if dataValues is None:
+        dataValues = data.to_numpy(dtype=np.float64)
+    if n + len(batch) > len(dataValues):
+        grown = np.empty((max(2 * len(dataValues), n + len(batch)), dataValues.shape[1]))
+        grown[:n] = dataValues[:n]
+        dataValues = grown
+    dataValues[n:n + len(batch)] = batch[data.columns].to_numpy(dtype=np.float64)
+    data = pd.DataFrame(dataValues[:n + len(batch)], columns=data.columns, copy=False)
+
+# Labels and medoid distances of new points against the medoids of the last clustering (no swaps)
+def assign_new(points):
+    settings = clustering["settings"]
+    medoidPoints = data.iloc[clustering["medoids"]][settings["features"]].to_numpy(dtype=np.float32)
+    return nearest_medoids(points[settings["features"]].to_numpy(dtype=np.float32), medoidPoints,
+                           MAX_DISTANCE_MEMORY, settings["metric"].lower())
+
+def stream_points():
+    global plotRows
+    batch = next(incoming, None)
+    if batch is None:
+        streamToggle.active = False
+        streamDiv.text = "No more points to stream"
+        return
+    start = len(data)
+    append_rows(batch)
+    # new points are always plotted, the oldest plotted points roll out of plotRows and of the source (see rollover)
+    plotRows = np.concatenate([plotRows, np.arange(start, len(data))])[-PLOT_POINTS:]
+    distanceCache.clear()
+    fingerprintCache.clear()
+
+    colors = ["darkgrey"] * len(batch)
+    if clustering:
+        labels, nearest = assign_new(batch)
+        colors = np.array(cluster_colors(clustering["settings"]["k"]))[labels].tolist()
+        clustering["streamed"] += len(batch)
+        clustering["streamedCost"] += float(nearest.sum(dtype=np.float64))
+    randomMedoids = source.data["Random"][0]
+    source.stream(dict(sepalL=batch[plotColumns["sepalL"]], sepalW=batch[plotColumns["sepalW"]],
+                       petalL=batch[plotColumns["petalL"]], petalW=batch[plotColumns["petalW"]], colors=colors,
+                       Random=[False] * len(batch)), rollover=PLOT_POINTS)
+    # (the random medoids flag lives in the first row, which may just have rolled out)
+    source.data["Random"][0] = randomMedoids
+
+    streamDiv.text = "%d points" % len(data)
+    if clustering and clustering["streamed"]:
+        mean = clustering["streamedCost"] / clustering["streamed"]
+        streamDiv.text += ", mean cost of %d new points: %.3f (clustering: %.3f)" % (
+            clustering["streamed"], mean, clustering["meanCost"])
+        if mean > clustering["meanCost"] * (1 + DRIFT_THRESHOLD) and not button.disabled:
+            streamDiv.text += ", reclustering"
+            start_clustering(dict(clustering["settings"]))
+
+streamToggle = Toggle(label="Stream new points", active=False)
+streamCallback = []
+
+def stream_handler(attr, old, new):
+    if new and not streamCallback:
+        streamCallback.append(doc.add_periodic_callback(stream_points, STREAM_INTERVAL))
+    elif not new and streamCallback:
+        doc.remove_periodic_callback(streamCallback.pop())
+
+streamToggle.on_change("active", stream_handler)
+streamDiv = Div(text="", width=200)
 # ______________________________________________________________________________________________________________________
 # text
 div = Div(text="""The final cost is: 99999""", width=200, height=100)
 # ______________________________________________________________________________________________________________________
-p2 = figure(title='Scatterplot of Flower distribution by petal width and petal length', x_range=(0, 2.6))
-p2.yaxis.axis_label = "Petal length"
-p2.xaxis.axis_label = "Petal width"
+p2 = figure(title=plot_title("petalW", "petalL"), x_range=axis_range("petalW"))
+p2.yaxis.axis_label = axis_label("petalL")
+p2.xaxis.axis_label = axis_label("petalW")
 p2.scatter("petalW", "petalL", fill_color="colors", line_color="colors", fill_alpha=.7, source=source)
 # use curdoc to add your widgets to the document
-curdoc().add_root(row(column(select, button, div), p, p2))
-curdoc().title = "DVA_ex_3"
+doc.add_root(row(column(select, algorithm, kInput, metric, features, restartsInput, init, seedInput, button,
+                        cancelButton, div, streamToggle, streamDiv), p, p2))
+doc.title = "DVA_ex_3"
 
 # use on of the commands below to start your application
 # bokeh serve --show dva_ex3_skeleton_HS20.py
@@ -0,0 +1,329 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# NumPy k-medoids engine for dva_ex3_skeleton_HS20.py. Points are the rows of an (n, d) float array, medoids are row
+# indices into it.
+
+# Default memory budget (in bytes) for distance computations
+MAX_BYTES = 256 * 1024 ** 2
+
+
+# Supported distance metrics
+METRICS = ("l1", "l2", "cosine")
+# Supported initializations of multi_restart
+INITS = ("random", "k-medoids++")
+
+
+# Distances between all rows of x and all rows of y as an (len(x), len(y)) float32 array, for metric "l1" (manhattan),
+# "l2" (euclidean) or "cosine" (1 - cosine similarity). The rows of y are processed in blocks, so the temporary arrays
+# (the (len(x), block, d) differences for l1, a few (len(x), block) arrays otherwise) stay within max_bytes.
+def pairwise_distances(x, y, metric="l1", max_bytes=MAX_BYTES):
+    if metric not in METRICS:
+        raise ValueError("unknown metric %r, expected one of %s" % (metric, ", ".join(METRICS)))
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.float32)
+    if metric == "cosine":
+        x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        y = y / np.maximum(np.linalg.norm(y, axis=1, keepdims=True), 1e-12)
+    x_sq = (x ** 2).sum(axis=1)[:, None] if metric == "l2" else None
+
+    out = np.empty((len(x), len(y)), dtype=np.float32)
+    per_column = 4 * len(x) * (x.shape[1] if metric == "l1" else 3)
+    block = max(1, max_bytes // max(1, per_column))
+    # the (len(x), block, d) differences of l1 are computed in place in this buffer, so they are the only temporary
+    diff = np.empty((len(x), min(block, len(y)), x.shape[1]), dtype=np.float32) if metric == "l1" else None
+    for start in range(0, len(y), block):
+        y_block = y[start:start + block]
+        target = out[:, start:start + block]
+        if metric == "l1":
+            block_diff = diff[:, :len(y_block)]
+            np.subtract(x[:, None, :], y_block[None, :, :], out=block_diff)
+            np.abs(block_diff, out=block_diff)
+            block_diff.sum(axis=2, out=target)
+        elif metric == "l2":
+            # |x - y|^2 = |x|^2 + |y|^2 - 2 x.y, clipped at 0 against rounding errors
+            np.matmul(x, y_block.T, out=target)
+            target *= -2
+            target += x_sq
+            target += (y_block ** 2).sum(axis=1)[None, :]
+            np.sqrt(np.maximum(target, 0, out=target), out=target)
+        else:
+            np.matmul(x, y_block.T, out=target)
+            np.subtract(1, target, out=target)
+            np.maximum(target, 0, out=target)
+    return out
+
+
+# Access to the columns of the n x n distance matrix of the data (see pairwise_distances for the metrics). If the whole
+# matrix fits into max_bytes it is computed once, otherwise the requested columns are computed block by block when they
+# are needed.
+class Distances:
+    def __init__(self, data, metric="l1", max_bytes=MAX_BYTES):
+        self.data = np.asarray(data, dtype=np.float32)
+        self.metric = metric
+        self.max_bytes = max_bytes
+        n = len(self.data)
+        self.matrix = pairwise_distances(self.data, self.data, metric, max_bytes) if 4 * n * n <= max_bytes else None
+
+    def __len__(self):
+        return len(self.data)
+
+    # distances of all points to the points cols, an (n, len(cols)) array
+    def columns(self, cols):
+        cols = np.asarray(cols, dtype=np.intp)
+        if self.matrix is not None:
+            # the matrix is symmetric, copying rows is much faster than gathering columns
+            return self.matrix[cols].T
+        return pairwise_distances(self.data, self.data[cols], self.metric, self.max_bytes)
+
+
+# Assigns every point to its closest medoid. Returns the cluster labels (positions in medoids), the distance of every
+# point to its medoid and the total cost (the sum of these distances).
+def assign(dist, medoids):
+    to_medoids = dist.columns(medoids)
+    labels = to_medoids.argmin(axis=1)
+    nearest = to_medoids[np.arange(len(labels)), labels]
+    return labels, nearest, float(nearest.sum(dtype=np.float64))
+
+
+# Caches of the swap phase: for every point the position (in medoids) of its closest medoid and the distances to its
+# closest and second closest medoid (inf if there is only one medoid).
+def nearest_two(dist, medoids):
+    to_medoids = dist.columns(medoids)
+    n = len(to_medoids)
+    if len(medoids) == 1:
+        return np.zeros(n, dtype=np.intp), to_medoids[:, 0].astype(np.float64), np.full(n, np.inf)
+    order = np.argpartition(to_medoids, 1, axis=1)[:, :2]
+    rows = np.arange(n)
+    first, second = to_medoids[rows, order[:, 0]], to_medoids[rows, order[:, 1]]
+    swap = second < first
+    nearest = np.where(swap, order[:, 1], order[:, 0])
+    return nearest, np.minimum(first, second).astype(np.float64), np.maximum(first, second).astype(np.float64)
+
+
+# Change of the total cost for every (medoid, candidate) swap of a block of candidate columns, a k x len(candidates)
+# array (FastPAM1). With d the distance of a point to the candidate and d1, d2 its cached distances to the closest and
+# second closest medoid, a point of the removed medoid's cluster ends up at min(d, d2), every other point at min(d, d1).
+# The part that is the same for all removals is summed once, the rest per cluster of the closest medoid: clusters is
+# the (k, n) float32 indicator matrix of the closest medoids (see cluster_indicator), which is the same for all blocks
+# of an iteration. (The product runs in BLAS and for the k of the dashboard is faster than sorting every block by
+# cluster for np.add.reduceat.)
+def swap_deltas(dist_block, clusters, d1, d2):
+    d1 = d1.astype(np.float32)[:, None]
+    gain = dist_block - d1
+    np.minimum(gain, 0, out=gain)
+    own = np.minimum(dist_block, d2.astype(np.float32)[:, None])
+    own -= d1
+    own -= gain
+    return gain.sum(axis=0, dtype=np.float64)[None, :] + clusters @ own
+
+
+# The (k, n) float32 matrix with a 1 where point j is closest to medoid i (nearest[j] == i)
+def cluster_indicator(nearest, k):
+    return (nearest[None, :] == np.arange(k)[:, None]).astype(np.float32)
+
+
+# Runs k-medoids (PAM) from the initial medoids. Every iteration evaluates all swaps of a medoid with a non-medoid point
+# from the cached nearest and second nearest medoid distances (see swap_deltas), candidate columns a block at a time,
+# and makes the single best one. Stops when no swap lowers the cost. Returns the medoids, the labels and the final cost.
+# data is either a Distances object or the (n, d) points.
+# callback(medoids, labels, cost) is called with the initial clustering and after every swap. If the threading.Event
+# cancel is set, the search stops between two candidate blocks and the clustering of the last finished swap is returned.
+def k_medoids(data, medoids, max_bytes=MAX_BYTES, metric="l1", callback=None, cancel=None):
+    dist = data if isinstance(data, Distances) else Distances(data, metric, max_bytes)
+    medoids = np.array(medoids, dtype=np.intp)
+    k, n = len(medoids), len(dist)
+    # a few (n, block) float64 temporaries per candidate block
+    block = max(1, dist.max_bytes // (32 * n))
+
+    nearest, d1, d2 = nearest_two(dist, medoids)
+    cost = d1.sum()
+    while True:
+        if callback:
+            callback(medoids.copy(), nearest, float(cost))
+        candidates = np.setdiff1d(np.arange(n), medoids)
+        clusters = cluster_indicator(nearest, k)
+        best_delta, best_swap = 0.0, None
+        for start in range(0, len(candidates), block):
+            if cancel is not None and cancel.is_set():
+                return medoids, nearest, float(cost)
+            cols = candidates[start:start + block]
+            deltas = swap_deltas(dist.columns(cols), clusters, d1, d2)
+            j, c = np.unravel_index(deltas.argmin(), deltas.shape)
+            if deltas[j, c] < best_delta:
+                best_delta, best_swap = deltas[j, c], (j, cols[c])
+
+        # (the deltas are float32 sums, the tolerance keeps rounding errors from swapping back and forth forever)
+        if best_swap is None or best_delta > -1e-6 * max(cost, 1.0):
+            break
+        medoids[best_swap[0]] = best_swap[1]
+        nearest, d1, d2 = nearest_two(dist, medoids)
+        cost = d1.sum()
+
+    return medoids, nearest, float(cost)
+
+
+# Assigns all rows of data to the closest of the medoid points (an (k, d) array), chunk_rows rows at a time so only a
+# (chunk_rows, k) block of distances (and its temporaries) exists at once. Returns the labels and the distance of every
+# row to its medoid.
+def nearest_medoids(data, medoid_points, max_bytes=MAX_BYTES, metric="l1"):
+    medoid_points = np.asarray(medoid_points, dtype=np.float32)
+    chunk_rows = max(1, max_bytes // (4 * len(medoid_points) * max(3, medoid_points.shape[1])))
+    labels = np.empty(len(data), dtype=np.intp)
+    nearest = np.empty(len(data), dtype=np.float32)
+    for start in range(0, len(data), chunk_rows):
+        block = pairwise_distances(data[start:start + chunk_rows], medoid_points, metric, max_bytes)
+        labels[start:start + chunk_rows] = block.argmin(axis=1)
+        nearest[start:start + chunk_rows] = block.min(axis=1)
+    return labels, nearest
+
+
+# nearest_medoids with the total cost instead of the distances
+def assign_chunked(data, medoid_points, max_bytes=MAX_BYTES, metric="l1"):
+    labels, nearest = nearest_medoids(data, medoid_points, max_bytes, metric)
+    return labels, float(nearest.sum(dtype=np.float64))
+
+
+# CLARA for datasets too large for PAM: runs k_medoids on n_samples random samples of sample_size rows (every sample
+# after the first also contains the best medoids found so far), scores the medoids of every sample on the full data
+# with assign_chunked and keeps the best ones. Memory is bounded by the sample size and max_bytes, not by len(data).
+# Returns the medoids (row indices into data), the labels of all rows and the cost.
+# callback(medoids, labels, cost) is called with the best clustering after every sample. If the threading.Event cancel
+# is set, no further samples are drawn and the best clustering so far is returned.
+def clara(data, k, n_samples=5, sample_size=None, rng=None, max_bytes=MAX_BYTES, metric="l1", callback=None,
+          cancel=None):
+    rng = np.random.default_rng(rng)
+    n = len(data)
+    sample_size = min(n, sample_size or 40 + 2 * k)
+    best_medoids, best_labels, best_cost = None, None, np.inf
+
+    for _ in range(n_samples):
+        if cancel is not None and cancel.is_set() and best_medoids is not None:
+            break
+        sample = rng.choice(n, sample_size, replace=False)
+        if best_medoids is None:
+            init = rng.choice(sample_size, k, replace=False)
+        else:
+            # continue from the best medoids so far, which are added to the sample
+            sample = np.union1d(best_medoids, sample)
+            init = np.searchsorted(sample, best_medoids)
+        sample_data = np.asarray(data[sample], dtype=np.float32)
+        medoids, _, _ = k_medoids(sample_data, init, max_bytes, metric, cancel=cancel)
+        medoids = sample[medoids]
+
+        labels, cost = assign_chunked(data, data[medoids], max_bytes, metric)
+        if cost < best_cost:
+            best_medoids, best_labels, best_cost = medoids, labels, cost
+        if callback:
+            callback(best_medoids, best_labels, float(best_cost))
+
+    return best_medoids, best_labels, float(best_cost)
+
+
+# k-medoids++ initialization: the first medoid is a random point, every further one is drawn with a probability
+# proportional to the squared distance of a point to its closest medoid so far.
+def kmedoids_plus_plus(dist, k, rng=None):
+    rng = np.random.default_rng(rng)
+    n = len(dist)
+    medoids = [int(rng.integers(n))]
+    closest = dist.columns(medoids)[:, 0].astype(np.float64)
+    for _ in range(1, k):
+        weights = closest ** 2
+        total = weights.sum()
+        if total > 0:
+            medoid = int(rng.choice(n, p=weights / total))
+        else:
+            # all points coincide with a medoid, any other point will do
+            medoid = int(rng.choice(np.setdiff1d(np.arange(n), medoids)))
+        medoids.append(medoid)
+        np.minimum(closest, dist.columns([medoid])[:, 0], out=closest)
+    return np.array(medoids, dtype=np.intp)
+
+
+def initial_medoids(dist, k, init="random", rng=None):
+    if init not in INITS:
+        raise ValueError("unknown init %r, expected one of %s" % (init, ", ".join(INITS)))
+    rng = np.random.default_rng(rng)
+    if init == "random":
+        return rng.choice(len(dist), k, replace=False)
+    return kmedoids_plus_plus(dist, k, rng)
+
+
+# The Distances object of the restarts in a worker process of multi_restart, set by the initializer of the pool. It is
+# only ever set in the worker processes, never in the process (e.g. the bokeh server) that calls multi_restart.
+_restart_dist = None
+
+
+def _init_restart_worker(dist):
+    global _restart_dist
+    _restart_dist = dist
+
+
+# One restart: k_medoids from the initialization drawn with seed
+def run_restart(dist, seed, k, init):
+    return k_medoids(dist, initial_medoids(dist, k, init, seed))
+
+
+# Worker of the process pool
+def _run_restart(seed, k, init):
+    return run_restart(_restart_dist, seed, k, init)
+
+
+# Start method of the restart pool. Forking a threaded process (like the bokeh server) can copy locks that are held
+# by other threads, so the workers are started fresh and get the distances through the initializer. They import this
+# module by name with the sys.path of this process, which bokeh serve only extends by the app directory while it runs
+# the app script, so the directory of this module is added for good.
+def _pool_context():
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    if module_dir not in sys.path:
+        sys.path.append(module_dir)
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+# Runs k_medoids from n_restarts initializations (random or k-medoids++, see INITS) in parallel on n_workers processes
+# (all cores for None, in this process for 1) and keeps the clustering with the lowest cost. The seed of every restart
+# is spawned from seed with np.random.SeedSequence, so the results do not depend on the number of workers or on the
+# order in which the restarts finish. Returns the best medoids, labels and cost and the costs of all restarts (nan for
+# restarts that did not run).
+# callback(medoids, labels, cost) is called with the best clustering whenever a restart finishes. If the
+# threading.Event cancel is set, the restarts that did not start yet are dropped (running ones still finish).
+def multi_restart(data, k, n_restarts=16, seed=0, init="random", n_workers=None, max_bytes=MAX_BYTES, metric="l1",
+                  callback=None, cancel=None):
+    dist = data if isinstance(data, Distances) else Distances(data, metric, max_bytes)
+    seeds = np.random.SeedSequence(seed).spawn(n_restarts)
+    costs = np.full(n_restarts, np.nan)
+    best_medoids, best_labels, best_cost = None, None, np.inf
+
+    def finished(i, result):
+        nonlocal best_medoids, best_labels, best_cost
+        medoids, labels, costs[i] = result
+        if costs[i] < best_cost:
+            best_medoids, best_labels, best_cost = medoids, labels, costs[i]
+        if callback:
+            callback(best_medoids, best_labels, float(best_cost))
+
+    if n_workers == 1 or n_restarts == 1:
+        for i, restart_seed in enumerate(seeds):
+            if cancel is not None and cancel.is_set() and best_medoids is not None:
+                break
+            finished(i, run_restart(dist, restart_seed, k, init))
+        return best_medoids, best_labels, float(best_cost), costs
+
+    with ProcessPoolExecutor(n_workers, mp_context=_pool_context(), initializer=_init_restart_worker,
+                             initargs=(dist,)) as pool:
+        futures = {pool.submit(_run_restart, restart_seed, k, init): i for i, restart_seed in enumerate(seeds)}
+        for future in as_completed(futures):
+            finished(futures[future], future.result())
+            if cancel is not None and cancel.is_set():
+                pool.shutdown(wait=True, cancel_futures=True)
+                # keep the restarts that were still running
+                for other, i in futures.items():
+                    if other.done() and not other.cancelled() and np.isnan(costs[i]):
+                        finished(i, other.result())
+                break
+    return best_medoids, best_labels, float(best_cost), costs
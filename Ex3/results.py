@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Cache of clustering results for dva_ex3_skeleton_HS20.py. bokeh serve runs the app script once per session but
+# imports this module only once, so the caches returned by result_cache are shared by all sessions of a server.
+
+
+# Hash of the data matrix (read chunk_rows rows at a time) and its shape.
+def data_fingerprint(data, chunk_rows=65536):
+    h = hashlib.blake2b(repr(data.shape).encode(), digest_size=16)
+    for start in range(0, len(data), chunk_rows):
+        h.update(np.ascontiguousarray(data[start:start + chunk_rows], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+# Key of a clustering result: the fingerprint of the data and all parameters the result depends on.
+def result_key(fingerprint, **params):
+    return hashlib.blake2b(json.dumps([fingerprint, params], sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+# Bounded LRU cache of clustering results (medoids, labels, cost and the costs of all restarts or None). At most
+# max_entries results are kept in memory. With cache_dir every result is also stored as cache_dir/<key>.npz, so results
+# survive a restart of the server; the max_entries least recently used files are kept there as well.
+class ResultCache:
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if not self.cache_dir or not os.path.exists(self._file(key)):
+            return None
+        try:
+            with np.load(self._file(key)) as cached:
+                result = (cached["medoids"], cached["labels"], float(cached["cost"]),
+                          cached["costs"] if cached["has_costs"] else None)
+            os.utime(self._file(key))
+        except (OSError, ValueError, KeyError):
+            return None
+        self._remember(key, result)
+        return result
+
+    def put(self, key, medoids, labels, cost, costs=None):
+        result = (np.asarray(medoids), np.asarray(labels), float(cost), costs)
+        self._remember(key, result)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = os.path.join(self.cache_dir, "tmp_%s_%d.npz" % (key, threading.get_ident()))
+            np.savez(tmp, medoids=result[0], labels=result[1], cost=cost, has_costs=costs is not None,
+                     costs=np.asarray(costs if costs is not None else [], dtype=np.float64))
+            os.replace(tmp, self._file(key))
+            self._trim_dir()
+
+    def _remember(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # removes the least recently used (by mtime) result files beyond max_entries
+    def _trim_dir(self):
+        files = [entry for entry in os.scandir(self.cache_dir)
+                 if entry.name.endswith(".npz") and not entry.name.startswith("tmp_")]
+        files.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in files[:max(0, len(files) - self.max_entries)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# The ResultCache for these settings, created by the first session that asks for it.
+def result_cache(max_entries=32, cache_dir=None):
+    with _caches_lock:
+        key = (max_entries, cache_dir and os.path.abspath(cache_dir))
+        if key not in _caches:
+            _caches[key] = ResultCache(max_entries, cache_dir)
+        return _caches[key]
@@ -1,133 +1,58 @@
 import numpy as np
 import os
+import time
+from html import escape
 
-import bokeh
 from bokeh.layouts import layout, row
-from bokeh.plotting import figure, output_file, show
-from bokeh.models import ColorBar, LinearColorMapper, BasicTicker
+from bokeh.plotting import figure, output_file, show, curdoc
+from bokeh.models import ColorBar, LinearColorMapper, BasicTicker, Slider, Toggle, Div
 from colorcet import CET_L16
 
-from colorsys import hsv_to_rgb
+from wind import FrameLoader, wind_levels
 
-output_file('DVA_ex4.html')
 color = CET_L16
-
-def to_bokeh_image(rgba_uint8):
-    if len(rgba_uint8.shape) > 2 \
-            and int(bokeh.__version__.split(".")[0]) >= 2 \
-            and int(bokeh.__version__.split(".")[1]) >= 2:
-        np_img2d = np.zeros(shape=rgba_uint8.shape[:2], dtype=np.uint32)
-        view = np_img2d.view(dtype=np.uint8).reshape(rgba_uint8.shape)
-        view[:] = rgba_uint8[:]
-    else:
-        np_img2d = rgba_uint8
-    return [np_img2d]
-
-def get_divergence(vx_wind, vy_wind):
-    # Use np.gradient to calculate the gradient of a vector field. Find out what exactly the return values represent and
-    # use the appropriate elements for your calculations
-    grad1x, grad1y, grad1z = np.gradient(vx_wind)
-    grad2x, grad2y, grad2z = np.gradient(vy_wind)
-
-    div_v = np.add(grad1x, grad2y)
-
-    return div_v
-
-def get_vorticity(vx_wind, vy_wind):
-    # Calculate the gradient again and use the appropriate results to calculate the vorticity. Think about what happens
-    # to the z-component and the derivatives with respect to z for a two dimensional vector field.
-    # (You can save the gradient in the divergence calculations or recalculate it here. Since the gradient function is
-    # fast and we have rather small data slices the impact of recalculating it is negligible.)
-
-    grad1x, grad1y, grad1z = np.gradient(vx_wind)
-    grad2x, grad2y, grad2z = np.gradient(vy_wind)
-
-    vort_v = np.subtract(grad2x, grad1y)
-
-    return vort_v
-
-# Calculates the HSV colors of the xy-windspeed vectors and maps them to RGBA colors
-def angle(vector):  #https://stackoverflow.com/questions/64561040/finding-angle-between-the-x-axis-and-a-vector-on-the-unit-circle
-    vector_2 = [1,0]
-    vector1 = vector / np.linalg.norm(vector)
-    vector2 = vector_2 / np.linalg.norm(vector_2)
-    dot_product = np.dot(vector1, vector2)
-    angle = np.arccos(dot_product)
-    return angle
-
-def vector_color_coding(vx_wind, vy_wind):
-    # Calculate the hue (H) as the angle between the vector and the positive x-axis
-    xv_wind = vx_wind[:, :, 20]
-    yv_wind = vy_wind[:, :, 20]
-
-    H = np.zeros((len(vx_wind), len(vx_wind[0])))
-
-    for i in range(len(xv_wind)):
-        for j in range(len(xv_wind[0])):
-            H[i, j] = np.arctan2(xv_wind[i, j], yv_wind[i, j])
-    # print(H.max(), H.min())# between -pi and pi
-    # print(H.shape)
-
-    # Saturation (S) can be set to 1
-    S = 1
-
-    # The brightness value (V) is set on the normalized magnitude of the vector
-
-    V = np.sqrt(xv_wind ** 2 + yv_wind ** 2)    # 500 x 500
-    V = (V - np.min(V)) / (np.max(V) - np.min(V))
-    V = V*255
-    # print(V.max(), V.min())# between -pi and pi
-    # print(V.shape)
-
-    # normalize
-    H = H+np.pi
-    H = H/(2*np.pi)
-    # print(H.shape)
-    # print(H.max(), H.min())  # 0.9999990652763828 6.702438916249953e-06
-
-    # Either use colorsys.hsv_to_rgb or implement the color conversion yourself using the
-    # algorithm for the HSV to RGB conversion, see https://www.rapidtables.com/convert/color/hsv-to-rgb.html
-    rgba_colors = np.zeros((len(V), len(V[0]), 4))
-
-    for i in range(len(V)):
-        for j in range(len(V[0])):
-            rgba_colors[i, j,0], rgba_colors[i, j,1], rgba_colors[i, j, 2] = hsv_to_rgb(H[i, j], S, V[i, j])
-            rgba_colors[i, j, 3] = 255    #probl.
-
-
-    # rgba_colors=rgba_colors.astype(int)
-    # print(rgba_colors.max(), rgba_colors.min())
-    # print(rgba_colors)
-    # print(rgba_colors.shape) # (500, 500, 4)
-
-    # The RGBA colors have to be saved as uint8 for the bokeh plot to properly work
-    return rgba_colors.astype('uint8')
+doc = curdoc()
+
+# Grid of the wind volumes (x, y, z) and the z-level that is shown first
+GRID_SHAPE = (500, 500, 100)
+LEVEL = 20
+# Run with bokeh serve the script shows a level slider. The derived fields of the last LEVEL_CACHE_SIZE levels (about
+# 5 MB per level for the 500 x 500 grid) are cached for all sessions, and the PREFETCH_RADIUS levels above and below the
+# shown one are computed in the background.
+LEVEL_CACHE_SIZE = GRID_SHAPE[2]
+PREFETCH_RADIUS = 3
+# The wind files of the timesteps (hours 1 to 48), hour HOUR is shown first. The animation shows one timestep every
+# ANIMATION_INTERVAL milliseconds, a background thread loads up to ANIMATION_BUFFER timesteps ahead
+X_WIND_FILES = 'Uf%02d.bin'
+Y_WIND_FILES = 'Vf%02d.bin'
+HOUR = 24
+ANIMATION_INTERVAL = 200
+ANIMATION_BUFFER = 8
+# The volumes are converted once into native float32 .npy files in this directory (next to the wind files), None reads
+# the big-endian files directly every time
+CONVERSION_CACHE = "cache"
 
 # Load and process the required data
 print('processing data')
-xWind_file = 'Uf24.bin'
-xWind_path = os.path.abspath(os.path.dirname(xWind_file))
-xWind_data = np.fromfile(os.path.join(xWind_path, xWind_file), dtype=np.dtype('>f'))
-xWind_data = np.reshape(xWind_data, [500, 500, 100], order='F')
-xWind_data = np.flipud(xWind_data)
-
-# Replace the missing "no data" values with the average of the dataset
-filtered_average = np.average(xWind_data[xWind_data < 1e35])
-xWind_data[xWind_data == 1e35] = filtered_average
-
-yWind_file = 'Vf24.bin'
-yWind_path = os.path.abspath(os.path.dirname(yWind_file))
-yWind_data = np.fromfile(os.path.join(yWind_path, yWind_file), dtype=np.dtype('>f'))
-yWind_data = np.reshape(yWind_data, [500, 500, 100], order='F')
-yWind_data = np.flipud(yWind_data)
-
-# Replace the missing "no data" values with the average of the dataset
-filtered_average = np.average(yWind_data[yWind_data < 1e35])
-yWind_data[yWind_data == 1e35] = filtered_average
-
-wind_vcc = vector_color_coding(xWind_data, yWind_data)
-wind_divergence = get_divergence(xWind_data, yWind_data)
-wind_vorticity = get_vorticity(xWind_data, yWind_data)
+# The volumes are memory mapped, only the shown levels are read (see wind.WindVolume, which also flips the levels and
+# replaces the missing "no data" values with the average of the dataset)
+data_path = os.path.abspath(os.path.dirname(X_WIND_FILES))
+hours = [hour for hour in range(1, 49)
+         if os.path.exists(os.path.join(data_path, X_WIND_FILES % hour))
+         and os.path.exists(os.path.join(data_path, Y_WIND_FILES % hour))] or [HOUR]
+# the first timestep that is shown, HOUR if its files exist
+start_hour = HOUR if HOUR in hours else hours[0]
+
+# All images of a level of a timestep (the wind speeds, divergence, vorticity and vector color coding, see
+# wind.WindLevels) are cached by (hour, level), for all sessions of the server
+windLevels, levelCache = wind_levels(os.path.join(data_path, X_WIND_FILES), os.path.join(data_path, Y_WIND_FILES),
+                                     GRID_SHAPE, CONVERSION_CACHE and os.path.join(data_path, CONVERSION_CACHE),
+                                     LEVEL_CACHE_SIZE)
+xWind_volume, yWind_volume = windLevels.volumes(start_hour)
+fields = levelCache.get((start_hour, LEVEL))
+wind_vcc = fields["vcc"]
+wind_divergence = fields["divergence"]
+wind_vorticity = fields["vorticity"]
 print('data processing completed')
 
 fig_args = {'x_range': (0,500), 'y_range': (0,500), 'width': 500, 'height': 400, 'toolbar_location': None, 'active_scroll': 'wheel_zoom'}
@@ -135,39 +60,142 @@ img_args = {'dh': 500, 'dw': 500, 'x': 0, 'y': 0}
 cb_args = {'ticker': BasicTicker(), 'label_standoff': 12, 'border_line_color': None, 'location': (0,0)}
 
 # Create x wind speed plot
-color_mapper_xWind = LinearColorMapper(palette=CET_L16, low=np.amin(xWind_data), high=np.amax(xWind_data))
+color_mapper_xWind = LinearColorMapper(palette=CET_L16, low=xWind_volume.stats()[1], high=xWind_volume.stats()[2])
 xWind_plot = figure(title="x-Wind speed (West - East)", **fig_args)
-xWind_plot.image(image=to_bokeh_image(xWind_data[:,:,20]), color_mapper=color_mapper_xWind, **img_args)
+xWind_plot.image(image=[fields["x"]], color_mapper=color_mapper_xWind, **img_args)
 xWind_color_bar = ColorBar(color_mapper=color_mapper_xWind, **cb_args)
 xWind_plot.add_layout(xWind_color_bar, 'right')
 
 # Create y wind speed plot
-color_mapper_yWind = LinearColorMapper(palette=CET_L16, low=np.amin(yWind_data), high=np.amax(yWind_data))
+color_mapper_yWind = LinearColorMapper(palette=CET_L16, low=yWind_volume.stats()[1], high=yWind_volume.stats()[2])
 yWind_plot = figure(title="y-Wind speed South - North", **fig_args)
-yWind_plot.image(image=to_bokeh_image(yWind_data[:,:,20]), color_mapper=color_mapper_yWind, **img_args)
+yWind_plot.image(image=[fields["y"]], color_mapper=color_mapper_yWind, **img_args)
 yWind_color_bar = ColorBar(color_mapper=color_mapper_yWind, **cb_args)
 yWind_plot.add_layout(yWind_color_bar, 'right')
 
 # _____________________________________________________________________________________________________________________
 # Create divergence plot
-color_mapper_DivWind = LinearColorMapper(palette=CET_L16, low=np.amin(wind_divergence[:, :, 20]), high=np.amax(wind_divergence[:, :, 20]))
+color_mapper_DivWind = LinearColorMapper(palette=CET_L16, low=np.amin(wind_divergence), high=np.amax(wind_divergence))
 divergence_plot = figure(title="Divergence", **fig_args)
-divergence_plot.image(image=to_bokeh_image(wind_divergence[:, :, 20]), color_mapper=color_mapper_DivWind, **img_args)
+divergence_plot.image(image=[wind_divergence], color_mapper=color_mapper_DivWind, **img_args)
 DivWind_color_bar = ColorBar(color_mapper=color_mapper_DivWind, **cb_args)
 divergence_plot.add_layout(DivWind_color_bar, 'right')
 
 # Create vorticity plot
-color_mapper_VolWind = LinearColorMapper(palette=CET_L16, low=np.amin(wind_vorticity[:, :, 20]), high=np.amax(wind_vorticity[:, :, 20]))
+color_mapper_VolWind = LinearColorMapper(palette=CET_L16, low=np.amin(wind_vorticity), high=np.amax(wind_vorticity))
 vorticity_plot = figure(title="Vorticity", **fig_args)
-vorticity_plot.image(image=to_bokeh_image(wind_vorticity[:, :, 20]), color_mapper=color_mapper_VolWind, **img_args)
+vorticity_plot.image(image=[wind_vorticity], color_mapper=color_mapper_VolWind, **img_args)
 VolWind_color_bar = ColorBar(color_mapper=color_mapper_VolWind, **cb_args)
 vorticity_plot.add_layout(DivWind_color_bar, 'right')
 
 # Create vector color coding plot
 # Use the bokeh image_rgba function for the plotting
 vcc_plot = figure(title="Vector Color Coding", **fig_args)
-vcc_plot.image_rgba(image=to_bokeh_image(wind_vcc), **img_args)
+vcc_plot.image_rgba(image=[wind_vcc], **img_args)
+
+# Shows the images of a level of a timestep. The wind speeds are color mapped by the range of their volume, divergence
+# and vorticity by the range of the level.
+def show_fields(hour, fields):
+    for plot, name in ((xWind_plot, "x"), (yWind_plot, "y"), (divergence_plot, "divergence"),
+                       (vorticity_plot, "vorticity"), (vcc_plot, "vcc")):
+        plot.renderers[0].data_source.data = {"image": [fields[name]]}
+    xWind_volume, yWind_volume = windLevels.volumes(hour)
+    color_mapper_xWind.update(low=xWind_volume.stats()[1], high=xWind_volume.stats()[2])
+    color_mapper_yWind.update(low=yWind_volume.stats()[1], high=yWind_volume.stats()[2])
+    color_mapper_DivWind.update(low=np.amin(fields["divergence"]), high=np.amax(fields["divergence"]))
+    color_mapper_VolWind.update(low=np.amin(fields["vorticity"]), high=np.amax(fields["vorticity"]))
+
+def show_level(hour, level):
+    show_fields(hour, levelCache.get((hour, level)))
+    # the closest levels first
+    levelCache.prefetch([(hour, other) for other in sorted(range(max(0, level - PREFETCH_RADIUS),
+                                                                 min(GRID_SHAPE[2], level + PREFETCH_RADIUS + 1)),
+                                                           key=lambda other: abs(other - level))])
+
+def level_handler(attr, old, new):
+    if playing():
+        start_animation()
+    else:
+        show_level(hours[hour_slider.value], new)
+
+def hour_handler(attr, old, new):
+    # (while the animation runs the slider only follows it)
+    if not playing():
+        show_level(hours[new], level_slider.value)
+
+# ______________________________________________________________________________________________________________________
+# Animation over the timesteps. The frames (the images of the shown level of every timestep) are loaded ahead of the
+# playhead by a wind.FrameLoader; a frame that is not ready in time is dropped instead of stalling the animation.
+animation = {}
+
+def playing():
+    return "loader" in animation
+
+def start_animation():
+    stop_animation()
+    level = level_slider.value
+    # the tick of the shown timestep, the loader starts with the next one
+    animation["tick"] = hour_slider.value
+    animation["loader"] = FrameLoader(lambda position: (hours[position], levelCache.get((hours[position], level))),
+                                      len(hours), ANIMATION_BUFFER, animation["tick"] + 1)
+    animation["dropped"] = 0
+    animation["shown"] = []
+    animation["callback"] = doc.add_periodic_callback(animation_frame, ANIMATION_INTERVAL)
+
+def stop_animation():
+    if playing():
+        animation.pop("loader").stop()
+        doc.remove_periodic_callback(animation.pop("callback"))
+
+def animation_frame():
+    loader = animation["loader"]
+    if loader.error is not None:
+        # (stops the animation through play_handler)
+        play_toggle.active = False
+        animation_div.text = "Loading the timesteps failed: %s" % escape(repr(loader.error))
+        return
+    animation["tick"] += 1
+    frame = loader.frame(animation["tick"])
+    if frame is None:
+        animation["dropped"] += 1
+    else:
+        hour, fields = frame
+        show_fields(hour, fields)
+        hour_slider.value = hours.index(hour)
+        animation["shown"] = (animation["shown"] + [time.perf_counter()])[-10:]
+    shown = animation["shown"]
+    fps = (len(shown) - 1) / (shown[-1] - shown[0]) if len(shown) > 1 and shown[-1] > shown[0] else 0.0
+    animation_div.text = "%.1f fps (target %.1f), %d frames dropped<br>loader: %d frames ahead, %.0f ms per frame" % (
+        fps, 1000 / ANIMATION_INTERVAL, animation["dropped"], loader.ahead(), loader.load_time() * 1000)
+
+# (the periodic callback ends with the session, the loader thread has to be stopped)
+def session_destroyed(session_context):
+    if playing():
+        animation["loader"].stop()
+
+def play_handler(attr, old, new):
+    if new:
+        start_animation()
+    else:
+        stop_animation()
 
 # Create and show plot layout
 final_layout = layout(row(xWind_plot, yWind_plot), row(divergence_plot, vorticity_plot, vcc_plot))
-show(final_layout)
\ No newline at end of file
+if doc.session_context is not None:
+    # bokeh serve --show dva_ex4_skeleton_HS20.py
+    level_slider = Slider(title="z-level", start=0, end=GRID_SHAPE[2] - 1, step=1, value=LEVEL)
+    level_slider.on_change("value", level_handler)
+    # (the slider selects a position in hours, hours without files are skipped)
+    hour_slider = Slider(title="Timestep (hour %d to %d)" % (hours[0], hours[-1]), start=0, end=max(1, len(hours) - 1),
+                         step=1, value=hours.index(start_hour), disabled=len(hours) < 2)
+    hour_slider.on_change("value", hour_handler)
+    play_toggle = Toggle(label="Play timesteps", active=False, disabled=len(hours) < 2)
+    play_toggle.on_change("active", play_handler)
+    animation_div = Div(text="")
+    show_level(hours[hour_slider.value], LEVEL)
+    doc.on_session_destroyed(session_destroyed)
+    doc.add_root(layout(row(level_slider, hour_slider, play_toggle, animation_div), final_layout))
+    doc.title = "DVA_ex_4"
+else:
+    output_file('DVA_ex4.html')
+    show(final_layout)
\ No newline at end of file
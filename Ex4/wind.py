@@ -0,0 +1,377 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+# NumPy helpers for dva_ex4_skeleton_HS20.py.
+
+
+# Source of every RGB channel (an index into (v, q, p, t)) for the six hue sectors of the HSV to RGB conversion, see
+# https://www.rapidtables.com/convert/color/hsv-to-rgb.html (and colorsys.hsv_to_rgb, which it reproduces)
+_SECTOR_CHANNELS = np.array([[0, 1, 2, 2, 3, 0],    # R
+                             [3, 0, 0, 1, 2, 2],    # G
+                             [2, 2, 3, 0, 0, 1]])   # B
+
+
+# Converts hue h (in [0, 1]), saturation s (in [0, 1]) and value v (in [0, 255]) arrays of the same shape (s may be a
+# scalar) to RGBA colors and writes them into out, an uint8 array of shape h.shape + (4,) that is allocated if it is
+# None. Like the uint8 cast of the colorsys results the colors are truncated, alpha is set to alpha.
+def hsv_to_rgba(h, s, v, alpha=255, out=None):
+    h = np.asarray(h)
+    v = np.asarray(v)
+    if out is None:
+        out = np.empty(h.shape + (4,), dtype=np.uint8)
+
+    h6 = h * 6
+    sector = h6.astype(np.intp)
+    f = h6 - sector
+    sector %= 6
+    components = np.stack([v, v * (1 - s * f), v * (1 - s), v * (1 - s * (1 - f))])
+    for channel, sources in enumerate(_SECTOR_CHANNELS):
+        out[..., channel] = np.take_along_axis(components, sources[sector][None], axis=0)[0]
+    out[..., 3] = alpha
+    return out
+
+
+# An uint32 image of the given shape and the shape + (4,) uint8 RGBA view of its bytes. Colors written into the view
+# (e.g. by hsv_to_rgba) are the image bokeh's image_rgba takes, without packing them into a new array.
+def rgba_buffer(shape):
+    image = np.empty(shape, dtype=np.uint32)
+    return image, image.view(np.uint8).reshape(tuple(shape) + (4,))
+
+
+# The vector color coding of the wind (vx, vy) on a level as an uint32 RGBA image (see rgba_buffer). The hue is the
+# angle of the vector (np.arctan2, normalized from [-pi, pi] to [0, 1]), the saturation 1 and the value the magnitude of
+# the vector, normalized to [0, 255] over the level.
+def vector_color_coding(vx, vy):
+    hue = np.arctan2(vx, vy).astype(np.float64)
+    hue = (hue + np.pi) / (2 * np.pi)
+    value = np.sqrt(vx ** 2 + vy ** 2)
+    value = (value - np.min(value)) / (np.max(value) - np.min(value)) * 255
+    image, rgba = rgba_buffer(hue.shape)
+    hsv_to_rgba(hue, 1, value, out=rgba)
+    return image
+
+
+# Serializes the conversions of WindVolume, which may be requested by several sessions and threads at once. It does not
+# reach other server processes (--num-procs) or a second server, those may convert the same file at the same time but
+# each writes its own temporary files, see temp_path.
+_conversion_lock = threading.Lock()
+
+
+# The name the file path is written under before it is swapped in with os.replace, unique per process and thread
+def temp_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "tmp_%d_%d_%s" % (os.getpid(), threading.get_ident(), name))
+
+
+# A wind volume file: big-endian float32 values of an (nx, ny, nz) grid in Fortran order, with missing values marked by
+# the sentinel. The file is memory mapped and only the z-levels that are asked for are read: in Fortran order every
+# level is one contiguous block of the file. Levels are returned as native float32 (nx, ny) arrays, flipped upside down
+# and with the missing values replaced by the average of all valid values of the volume.
+# With cache_dir the volume is converted once into cache_dir/<file name>.npy, already flipped, filled and in native
+# float32, next to a <file name>.json with the (size, mtime) of the source file and the stats. As long as the source
+# file does not change, the levels are then zero-copy views of the memory mapped .npy file.
+class WindVolume:
+    def __init__(self, path, shape=(500, 500, 100), dtype=">f4", sentinel=1e35, chunk_levels=8, cache_dir=None):
+        self.path = path
+        self.shape = tuple(shape)
+        self.raw = np.memmap(path, dtype=np.dtype(dtype), mode="r", shape=self.shape, order="F")
+        self.sentinel = self.raw.dtype.type(sentinel)
+        self.chunk_levels = chunk_levels
+        self._stats = None
+        self.converted = None
+        if cache_dir:
+            with _conversion_lock:
+                self.converted = self._load_converted(cache_dir)
+
+    # The mean, minimum and maximum of the valid values, computed once in a streamed pass over chunk_levels levels at a
+    # time (the original script averaged the whole volume in memory).
+    def stats(self):
+        if self._stats is None:
+            total, count = 0.0, 0
+            low, high = np.inf, -np.inf
+            for start in range(0, self.shape[2], self.chunk_levels):
+                chunk = self.raw[:, :, start:start + self.chunk_levels]
+                valid = chunk[chunk < self.sentinel].astype(np.float32)
+                if len(valid):
+                    total += valid.sum(dtype=np.float64)
+                    count += len(valid)
+                    low, high = min(low, float(valid.min())), max(high, float(valid.max()))
+            mean = total / count if count else 0.0
+            self._stats = (mean, low if count else mean, high if count else mean)
+        return self._stats
+
+    # raw values (already flipped) as native float32 with the missing values replaced
+    def _filled(self, raw):
+        out = raw.astype(np.float32)
+        missing = raw == self.sentinel
+        if missing.any():
+            out[missing] = self.stats()[0]
+        return out
+
+    def level(self, z):
+        if self.converted is not None:
+            return self.converted[:, :, z]
+        return self._filled(self.raw[::-1, :, z])
+
+    # The levels zs stacked into an (nx, ny, len(zs)) array
+    def levels(self, zs):
+        return np.stack([self.level(z) for z in zs], axis=2)
+
+    # The memory mapped converted volume of cache_dir, converted first if it is missing or outdated
+    def _load_converted(self, cache_dir):
+        name = os.path.basename(self.path)
+        data_file = os.path.join(cache_dir, name + ".npy")
+        info_file = os.path.join(cache_dir, name + ".json")
+        st = os.stat(self.path)
+        info = {"source": [st.st_size, st.st_mtime_ns], "shape": list(self.shape), "sentinel": float(self.sentinel)}
+
+        try:
+            with open(info_file) as f:
+                cached = json.load(f)
+            if all(cached[key] == value for key, value in info.items()):
+                converted = np.load(data_file, mmap_mode="r")
+                if converted.shape == self.shape and converted.dtype == np.float32:
+                    self._stats = tuple(cached["stats"])
+                    return converted
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # written next to the old files and then swapped in, the .json last, so a crash never leaves a half written
+        # volume that looks valid
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = temp_path(data_file)
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=self.shape, fortran_order=True)
+        for start in range(0, self.shape[2], self.chunk_levels):
+            chunk = slice(start, start + self.chunk_levels)
+            out[:, :, chunk] = self._filled(self.raw[::-1, :, chunk])
+        out.flush()
+        del out
+        os.replace(tmp, data_file)
+        info["stats"] = list(self.stats())
+        tmp = temp_path(info_file)
+        with open(tmp, "w") as f:
+            json.dump(info, f)
+        os.replace(tmp, info_file)
+        return np.load(data_file, mmap_mode="r")
+
+
+# Derivative of a 2D float32 field along axis with unit grid spacing: central differences inside, one-sided differences
+# at the borders (the same values as the matching component of np.gradient).
+def derivative(field, axis):
+    f = np.moveaxis(np.asarray(field, dtype=np.float32), axis, 0)
+    out = np.empty_like(f)
+    np.subtract(f[2:], f[:-2], out=out[1:-1])
+    out[1:-1] *= 0.5
+    np.subtract(f[1], f[0], out=out[0])
+    np.subtract(f[-1], f[-2], out=out[-1])
+    return np.moveaxis(out, 0, axis)
+
+
+# The partial derivatives of the wind (vx, vy) on one level, axis 0 is x and axis 1 is y. Every partial derivative is
+# computed once when it is first needed, so divergence and vorticity share dvx/dx, dvx/dy, dvy/dx and dvy/dy and no
+# z-derivative is ever computed.
+class LevelDerivatives:
+    def __init__(self, vx, vy):
+        self.fields = {"x": np.asarray(vx, dtype=np.float32), "y": np.asarray(vy, dtype=np.float32)}
+        self.partials = {}
+
+    # d v_component / d axis, for component and axis "x" or "y"
+    def partial(self, component, axis):
+        key = (component, axis)
+        if key not in self.partials:
+            self.partials[key] = derivative(self.fields[component], "xy".index(axis))
+        return self.partials[key]
+
+    # dvx/dx + dvy/dy
+    def divergence(self):
+        return self.partial("x", "x") + self.partial("y", "y")
+
+    # the z-component dvy/dx - dvx/dy (the other components contain z-derivatives and the z-component of the wind,
+    # which do not exist for a two dimensional vector field)
+    def vorticity(self):
+        return self.partial("y", "x") - self.partial("x", "y")
+
+
+# Bounded LRU cache of the derived fields of levels (or of any other hashable keys), compute(level) computes them on a
+# miss. prefetch(levels) hands levels to a background thread, which computes the ones that are not cached yet in the
+# given order; a new prefetch replaces the levels that were not computed yet, so the thread always works close to the
+# last requested level. A level whose computation fails is skipped by the thread, get raises the error when it is asked
+# for.
+class LevelCache:
+    def __init__(self, compute, max_entries=100):
+        self.compute = compute
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Condition()
+        self.wanted = []
+        self.thread = None
+
+    def get(self, level):
+        with self.lock:
+            if level in self.entries:
+                self.entries.move_to_end(level)
+                return self.entries[level]
+        result = self.compute(level)
+        self._store(level, result)
+        return result
+
+    def _store(self, level, result):
+        with self.lock:
+            self.entries[level] = result
+            self.entries.move_to_end(level)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def prefetch(self, levels):
+        with self.lock:
+            self.wanted = [level for level in levels if level not in self.entries]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+                self.thread.start()
+            self.lock.notify()
+
+    def _prefetch_loop(self):
+        while True:
+            with self.lock:
+                while not self.wanted:
+                    self.lock.wait()
+                level = self.wanted.pop(0)
+                if level in self.entries:
+                    continue
+            try:
+                result = self.compute(level)
+            except Exception:
+                continue
+            self._store(level, result)
+
+
+# The timesteps of a wind dataset: x_files and y_files are the paths of the x and y wind volumes with a %d for the hour
+# (e.g. Uf%02d.bin). The WindVolumes of a timestep are opened when they are first needed and kept, compute((hour,
+# level)) returns all images shown for a level of a timestep: the x and y wind speeds, divergence, vorticity and the
+# vector color coding ("vcc").
+class WindLevels:
+    def __init__(self, x_files, y_files, shape=(500, 500, 100), cache_dir=None):
+        self.x_files = x_files
+        self.y_files = y_files
+        self.shape = tuple(shape)
+        self.cache_dir = cache_dir
+        self.volume_cache = {}
+        self.lock = threading.Lock()
+
+    # the (x, y) WindVolumes of a timestep
+    def volumes(self, hour):
+        with self.lock:
+            if hour not in self.volume_cache:
+                self.volume_cache[hour] = (WindVolume(self.x_files % hour, self.shape, cache_dir=self.cache_dir),
+                                           WindVolume(self.y_files % hour, self.shape, cache_dir=self.cache_dir))
+            return self.volume_cache[hour]
+
+    def compute(self, key):
+        hour, level = key
+        x_volume, y_volume = self.volumes(hour)
+        vx = x_volume.level(level)
+        vy = y_volume.level(level)
+        derivatives = LevelDerivatives(vx, vy)
+        return {"x": vx, "y": vy, "divergence": derivatives.divergence(), "vorticity": derivatives.vorticity(),
+                "vcc": vector_color_coding(vx, vy)}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# The WindLevels of these files and settings and the LevelCache of its images (keyed by (hour, level)), created by the
+# first session that asks for them. bokeh serve imports this module only once, so all sessions of a server share them;
+# the cache only refers to this module, never to the session that created it.
+def wind_levels(x_files, y_files, shape=(500, 500, 100), cache_dir=None, max_entries=100):
+    with _caches_lock:
+        key = (x_files, y_files, tuple(shape), cache_dir and os.path.abspath(cache_dir), max_entries)
+        if key not in _caches:
+            levels = WindLevels(x_files, y_files, shape, cache_dir)
+            _caches[key] = (levels, LevelCache(levels.compute, max_entries))
+        return _caches[key]
+
+
+# Background loader of the frames of an animation. Frames are counted by ticks (the frame shown at tick t is
+# load(t % n_frames), so the animation loops) and a thread keeps the frames of the next size ticks after the playhead
+# in a ring buffer of size slots (the frame of tick t lives in slot t % size). The playhead starts at the tick start,
+# the first one that will be asked for. frame(tick) never waits: a frame that is not loaded yet is reported as missing
+# and the player drops it, and the loader skips everything behind the playhead. If load raises, the loader stops and
+# keeps the exception in error.
+class FrameLoader:
+    def __init__(self, load, n_frames, size=8, start=0):
+        self.load = load
+        self.n_frames = n_frames
+        self.size = size
+        self.slots = [None] * size
+        self.playhead = start
+        self.running = True
+        self.error = None
+        self.load_times = deque(maxlen=16)
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # the first tick of the window after the playhead that is not loaded, None if the ring buffer is full
+    def _next_tick(self):
+        for tick in range(self.playhead, self.playhead + self.size):
+            slot = self.slots[tick % self.size]
+            if slot is None or slot[0] != tick:
+                return tick
+        return None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                tick = self._next_tick()
+                while self.running and tick is None:
+                    self.lock.wait()
+                    tick = self._next_tick()
+                if not self.running:
+                    return
+            start = time.perf_counter()
+            try:
+                frame = self.load(tick % self.n_frames)
+            except Exception as error:
+                with self.lock:
+                    self.error = error
+                    self.running = False
+                return
+            with self.lock:
+                self.load_times.append(time.perf_counter() - start)
+                if tick >= self.playhead:
+                    self.slots[tick % self.size] = (tick, frame)
+
+    # Moves the playhead to tick and returns its frame, or None if it is not loaded yet
+    def frame(self, tick):
+        with self.lock:
+            self.playhead = tick
+            self.lock.notify()
+            slot = self.slots[tick % self.size]
+            return slot[1] if slot is not None and slot[0] == tick else None
+
+    # The number of frames after the playhead that are loaded already (0 when the loader lags behind)
+    def ahead(self):
+        with self.lock:
+            ahead = 0
+            for tick in range(self.playhead + 1, self.playhead + self.size):
+                slot = self.slots[tick % self.size]
+                if slot is None or slot[0] != tick:
+                    break
+                ahead += 1
+            return ahead
+
+    # mean time (in seconds) to load one of the last frames
+    def load_time(self):
+        with self.lock:
+            return sum(self.load_times) / len(self.load_times) if self.load_times else 0.0
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()